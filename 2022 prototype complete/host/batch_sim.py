@@ -0,0 +1,299 @@
+# US Naval Academy
+# Robotics and Control TSD
+#
+# Step responses of thousands of controller configurations at once, in numpy.
+#
+# Same control laws as control_loop_P / PI / PID in code.py (and controllers.build_P / PI / PID),
+# same units, same quantization, stepped in lockstep for every configuration:
+# 	error	= target - dx/dt						dx, dt over sample_offset samples, counts / ns
+# 	i_term	+= Ki * error * dt
+# 	d_term	= Kd * (error - last_error) / dt
+# 	code	= int(511.5 * (bias + Kp*error + i_term + d_term) + 0.5) + 511, clamped [0,1023]
+# 												AD5293_309.set_pot(), int() truncates toward 0
+# against the DC motor in sim/motor.py (first order, deadband, integrated exactly between ticks),
+# read through a 4x decoded encoder, int() of counts like the sim's rotaryio.
+#
+# Configurations are arrays that broadcast to one shape (n,), in the units the json intake takes
+# (rad/s, MATLAB gains, bias in x/512, rate in Hz). Plant parameters can vary per configuration too.
+# Results are arrays shaped (configs, time).
+#
+# ex:
+# 	configs = grid(Kp=np.linspace(2e-8,4e-7,20), Ki=np.linspace(0,4e-6,20), Kd=[0,3.14e-11])
+# 	run = simulate(configs, target=10, time_limit=1)
+# 	scores = score(run)
+# 	best = np.argmin(scores['iae'])
+#
+
+import numpy as np
+
+TAU = 2*np.pi
+
+# Every combination of the given axes, flattened to (n,) arrays.
+def grid(**axes):
+	names = list(axes)
+	mesh = np.meshgrid(*[np.atleast_1d(axes[name]) for name in names],indexing='ij')
+	return {name : m.ravel() for name, m in zip(names,mesh)}
+
+def _law_masks(law,n):
+	law = np.broadcast_to(np.asarray(law),(n,))
+	use_i = np.array([('I' in l) for l in law])
+	use_d = np.array([('D' in l) for l in law])
+	return use_i, use_d
+
+def _steady_state(code,gain,deadband,deadband_negative):
+	u = (code - 511.5) / 511.5
+	return np.where(u > deadband, gain*(u - deadband), np.where(u < -deadband_negative, gain*(u + deadband_negative), 0.0))
+
+# configs: dict of arrays, any of
+# 	Kp, Ki, Kd, bias, rate, target, law		law is 'P', 'PI' or 'PID', default 'PID'
+# 	gain, tau, deadband, deadband_negative		plant, default sim/motor.py's
+# 	counts_per_rev							the encoder's, firmware_counts_per_rev is what code.py was
+# 											told (default the same), for a station set up with the wrong one
+# Missing keys come from kwargs, then the defaults below.
+def _setup(configs,kwargs,n=None):
+	# Setup default values.
+	buffer = {
+		'Kp' : 9.42e-8,
+		'Ki' : 1.256e-6,
+		'Kd' : 3.14e-11,
+		'bias' : 0,					# x / 512, like the json intake
+		'rate' : 500,				# Hz
+		'target' : 10,				# rad/s
+		'law' : 'PID',
+		'gain' : 60.0,				# rad/s at full scale
+		'tau' : 0.05,				# s
+		'deadband' : 28 / 512,
+		'deadband_negative' : None,
+		'time_limit' : 1.0,			# s, same for every configuration
+		'counts_per_rev' : 2000,
+		'firmware_counts_per_rev' : None,
+		'sample_offset' : 2,		# code.py's sample_offset
+		'prefill_ns' : 5000			# time between the __prefill_arrays() samples
+	}
+	configs = dict(configs or {})
+	for arg in buffer:
+		buffer[arg] = configs.get(arg,kwargs.get(arg,buffer[arg]))
+	if (buffer['deadband_negative'] is None):
+		buffer['deadband_negative'] = buffer['deadband']
+	if (buffer['firmware_counts_per_rev'] is None):
+		buffer['firmware_counts_per_rev'] = buffer['counts_per_rev']
+
+	names = ['Kp','Ki','Kd','bias','rate','target','gain','tau','deadband','deadband_negative','counts_per_rev','firmware_counts_per_rev']
+	if (n is None):
+		n = max([np.size(buffer[name]) for name in names] + [np.size(buffer['law'])])
+	p = {name : np.broadcast_to(np.asarray(buffer[name],dtype=np.float64),(n,)).copy() for name in names}
+	use_i, use_d = _law_masks(buffer['law'],n)
+
+	# format_matlab_values() conversions.
+	conversion = p['firmware_counts_per_rev'] / TAU
+	gains = {
+		'target' : p['target'] * conversion / 10**9,		# counts / ns
+		'kp' : p['Kp'] * conversion * 10**9,
+		'ki' : np.where(use_i, p['Ki'] * conversion, 0.0),
+		'kd' : np.where(use_d, p['Kd'] * conversion * 10**18, 0.0),
+		'bias' : p['bias'] / 512
+	}
+	return buffer, p, n, gains
+
+# One tick of the control law at sample j, for the configurations still 'running'.
+# Returns the new code, i_term and last_error.
+def _control(counts,time,j,offset,gains,code,i_term,last_error,running):
+	dt = time[:,j] - time[:,j - offset]
+	dt = np.where(dt > 0, dt, 1.0)
+	error = gains['target'] - (counts[:,j] - counts[:,j - offset]) / dt
+	i_term = np.where(running, i_term + gains['ki']*error*dt, i_term)
+	d_term = gains['kd'] * (error - last_error) / dt
+	u = gains['bias'] + gains['kp']*error + i_term + d_term
+	new_code = np.clip(np.trunc(511.5*u + 0.5) + 511, 0, 1023)
+	code = np.where(running, new_code, code)
+	last_error = np.where(running, error, last_error)
+	return code, i_term, last_error
+
+def _prefill(offset):
+	return max(3,offset + 1)
+
+def simulate(configs=None,**kwargs):
+	buffer, p, n, gains = _setup(configs,kwargs)
+	cpr = p['firmware_counts_per_rev']
+	offset = buffer['sample_offset']
+	period = np.round(10**9 / p['rate'])					# ns
+
+	# check_quit stops the run at time_limit, ticks strictly before it run.
+	ticks = np.ceil(buffer['time_limit'] * 10**9 / period).astype(np.int64)
+	prefill = _prefill(offset)
+	steps = prefill + int(ticks.max())
+
+	time = np.zeros((n,steps))
+	counts = np.zeros((n,steps),dtype=np.int64)
+	codes = np.full((n,steps),511,dtype=np.int16)
+	valid = np.zeros((n,steps),dtype=bool)
+	valid[:,:prefill] = True
+
+	# Motor at rest, wiper at 511 (set_pot(0)) through the prefill.
+	theta = np.zeros(n)
+	omega = np.zeros(n)
+	code = np.full(n,511.0)
+	gain = p['gain']
+	tau = p['tau']
+	deadband = p['deadband']
+	deadband_negative = p['deadband_negative']
+	for j in range(prefill):
+		time[:,j] = j * buffer['prefill_ns']
+	start = time[:,prefill - 1]
+
+	i_term = np.zeros(n)
+	last_error = np.zeros(n)
+	last_time = start.copy()
+	scale = p['counts_per_rev'] / TAU
+	for k in range(steps - prefill):
+		j = prefill + k
+		running = k < ticks
+		now = np.where(running, start + k*period, last_time)
+
+		# Plant from the last tick to this one under the last code.
+		h = (now - last_time) / 10**9
+		w_ss = _steady_state(code,gain,deadband,deadband_negative)
+		decay = np.exp(-h / tau)
+		theta = theta + w_ss*h + (omega - w_ss)*tau*(1 - decay)
+		omega = w_ss + (omega - w_ss)*decay
+		last_time = now
+
+		time[:,j] = now
+		counts[:,j] = np.trunc(theta * scale)
+		valid[:,j] = running
+
+		code, i_term, last_error = _control(counts,time,j,offset,gains,code,i_term,last_error,running)
+		codes[:,j] = code
+
+	time = time - time[:,:1]
+	# runit()'s "final err" is a fraction of target. A 0 target has nothing to divide by, report rad/s instead.
+	moving = gains['target'] != 0
+	final_error = np.where(moving, last_error / np.where(moving, gains['target'], 1), last_error * 10**9 * TAU / cpr)
+	return {
+		'time' : time / 10**9,						# s since the first sample
+		'counts' : counts,
+		'position' : counts * (TAU / cpr)[:,None],	# rad, as the firmware reports it
+		'code' : codes,								# wiper code sent at each sample
+		'valid' : valid,							# False past each configuration's last tick
+		'target' : p['target'],
+		'counts_per_rev' : cpr,
+		'final_error' : final_error,				# fraction of target, rad/s where target is 0
+		'params' : p,
+		'law' : np.broadcast_to(np.asarray(buffer['law']),(n,))
+	}
+
+# Wiper codes the firmware sent for logged runs: bench counts and times (ns) since the first sample,
+# shaped (runs, samples), run back through the same control law. configs / kwargs as simulate().
+# valid marks real samples when runs of different lengths are padded to one array.
+def replay(counts,time,configs=None,valid=None,**kwargs):
+	counts = np.asarray(counts,dtype=np.float64)
+	time = np.asarray(time,dtype=np.float64)
+	buffer, p, n, gains = _setup(configs,kwargs,n=counts.shape[0])
+	offset = buffer['sample_offset']
+	if (valid is None):
+		valid = np.ones(counts.shape,dtype=bool)
+	codes = np.full(counts.shape,511,dtype=np.int16)
+	code = np.full(n,511.0)
+	i_term = np.zeros(n)
+	last_error = np.zeros(n)
+	for j in range(_prefill(offset),counts.shape[1]):
+		code, i_term, last_error = _control(counts,time,j,offset,gains,code,i_term,last_error,valid[:,j])
+		codes[:,j] = code
+	return codes
+
+# Per configuration scores, all arrays shaped (configs,).
+# Speed is dx/dt over 'window' samples, like the settle check on the bench data.
+# 	rise		s until speed first reaches 90% of target, inf if never
+# 	settle		s until speed stays within 'band' of target for the rest of the run, inf if never
+# 	overshoot	peak speed over target, fraction
+# 	final		mean speed error over the last 10% of the run, fraction of target
+# 	iae			integral of |speed error| / target, s
+# A 0 target has no fraction to give, its errors are in rad/s.
+# 	chatter		mean |change in wiper code| per tick, codes
+def score(run,band=0.05,window=10):
+	time = run['time']
+	counts = run['counts']
+	valid = run['valid']
+	target = run['target']
+	cpr = np.reshape(run['counts_per_rev'],(-1,1))
+	dt = time[:,window:] - time[:,:-window]
+	dt = np.where(dt > 0, dt, np.inf)
+	speed = (counts[:,window:] - counts[:,:-window]) * (TAU / cpr) / dt		# rad/s
+	t = time[:,window:]
+	ok = valid[:,window:]
+	# Fraction of target, or rad/s where the target is 0 (hold still).
+	scale = np.where(target != 0, np.abs(target), 1)[:,None]
+	error = (speed - target[:,None]) / scale * np.sign(np.where(target != 0, target, 1))[:,None]
+
+	outside = (np.abs(error) > band) & ok
+	last_outside = np.where(outside.any(axis=1), outside.shape[1] - 1 - np.argmax(outside[:,::-1],axis=1), -1)
+	last_valid = ok.shape[1] - 1 - np.argmax(ok[:,::-1],axis=1)
+	settled = last_outside < last_valid
+	index = np.minimum(last_outside + 1, ok.shape[1] - 1)
+	settle = np.where(settled, np.take_along_axis(t,index[:,None],axis=1)[:,0], np.inf)
+
+	reached = (error >= -0.1) & ok
+	rise = np.where(reached.any(axis=1), np.take_along_axis(t,np.argmax(reached,axis=1)[:,None],axis=1)[:,0], np.inf)
+
+	overshoot = np.max(np.where(ok, error, -np.inf),axis=1)
+	tail = ok & (t >= 0.9 * np.max(np.where(ok, t, 0),axis=1)[:,None])
+	final = np.sum(np.where(tail, error, 0),axis=1) / np.maximum(tail.sum(axis=1),1)
+	step = np.diff(t,axis=1,prepend=t[:,:1])
+	iae = np.sum(np.where(ok, np.abs(error)*step, 0),axis=1)
+	moves = valid[:,1:] & valid[:,:-1]
+	changes = np.abs(np.diff(run['code'].astype(np.int32),axis=1))
+	chatter = np.sum(np.where(moves, changes, 0),axis=1) / np.maximum(moves.sum(axis=1),1)
+	return {'rise' : rise, 'settle' : settle, 'overshoot' : overshoot, 'final' : final, 'iae' : iae, 'chatter' : chatter}
+
+
+
+
+###################################
+######### Testing Section #########
+###################################
+
+# Engine vs the firmware itself: code.py + the controllers run in the sim on the virtual clock.
+# ex:	python3 batch_sim.py
+def compare(cases=None):
+	import os
+	import subprocess
+	from json import dumps, loads
+	here = os.path.dirname(os.path.abspath(__file__))
+	firmware = os.path.join(here,'..','python')
+	env = dict(os.environ, PYTHONPATH=os.path.join(here,'..','sim'), SIM_VIRTUAL_CLOCK='1')
+	if (cases is None):
+		cases = [
+			{'target' : 10, 'Kp' : 9.42e-8, 'Ki' : 1.256e-6, 'Kd' : 0, 'bias' : 0},
+			{'target' : 5, 'Kp' : 2e-8, 'Ki' : 3e-7, 'Kd' : 0, 'bias' : 28},
+			{'target' : 20, 'Kp' : 1.9e-7, 'Ki' : 2e-6, 'Kd' : 3.14e-12, 'bias' : 0, 'rate' : 250},
+			{'target' : -8, 'Kp' : 9.42e-8, 'Ki' : 1.256e-6, 'Kd' : 0, 'bias' : 0}		# reverse, through deadband_negative
+		]
+	worst = 0
+	for case in cases:
+		case = dict(case, time_limit=0.5)
+		# Each case gets a fresh process, so it starts from rest like simulate() does.
+		out = subprocess.run(['python3','code.py'],input=dumps(case) + '\n',capture_output=True,text=True,cwd=firmware,env=env).stdout
+		bench = np.array([loads(line)['position'] for line in out.splitlines() if line.startswith('{')])
+		run = simulate(case,time_limit=0.5)
+		engine = run['position'][0,run['valid'][0]]
+		count = min(len(bench),len(engine))
+		diff = np.max(np.abs(bench[:count] - engine[:count])) * 2000 / TAU
+		worst = max(worst,diff)
+		print('LOG: ' + dumps(case) + ': ' + str(len(bench)) + ' vs ' + str(len(engine)) + ' samples, max diff ' + ('%0.0f' % diff) + ' counts of ' + ('%0.0f' % (engine[-1] * 2000 / TAU)))
+	return worst
+
+def benchmark(side=20):
+	from time import perf_counter
+	configs = grid(Kp=np.linspace(1e-8,4e-7,side), Ki=np.linspace(0,4e-6,side), Kd=np.linspace(0,6e-11,side))
+	start = perf_counter()
+	run = simulate(configs,target=10,time_limit=1)
+	scores = score(run)
+	elapsed = perf_counter() - start
+	best = np.argmin(np.where(np.isfinite(scores['settle']), scores['iae'], np.inf))
+	print('LOG: ' + str(len(configs['Kp'])) + ' configs x ' + str(run['time'].shape[1]) + ' samples in ' + ('%0.2f' % elapsed) + ' s')
+	print('LOG: best iae: Kp %0.3g, Ki %0.3g, Kd %0.3g, settle %0.3f s, overshoot %0.1f%%' %(configs['Kp'][best], configs['Ki'][best], configs['Kd'][best], scores['settle'][best], 100*scores['overshoot'][best]))
+
+
+if __name__ == '__main__':
+	compare()
+	benchmark()
@@ -0,0 +1,101 @@
+# US Naval Academy
+# Robotics and Control TSD
+#
+# Host-side calibration cache, for when CIRCUITPY is read-only to code.py and
+# python/calibration.py can't save to flash.
+#
+# The RP2040 prints its calibration as a 'CAL:' json line after find_bias():
+# 	CAL: {"key": "raspberry_pi_pico:e6614103e7...", "calibration": {"motor_bias": 0.055, ...}}
+# Those get kept in one json file on the host, keyed the same way.
+# The Board ID line of boot_out.txt on the CIRCUITPY drive finds the entries for a board.
+# ew305(port, calibration_cache=Calibration_Cache()) keeps every CAL: line it reads, and at
+# connect sends the board its cached biases if it came up without any (see ew305.sync_calibration()).
+#
+# ex:
+# 	cache = Calibration_Cache()
+# 	cache.update_from_line(line)			every line read from the serial port
+# 	cache.lookup(board_id('E:/boot_out.txt'))
+# 	cache.invalidate(key)
+#
+
+from json import loads, dumps
+from os import path as os_path, replace
+import threading
+
+PREFIX = 'CAL:'
+DEFAULT_PATH = os_path.join(os_path.expanduser('~'), '.ew305_calibration.json')
+
+# 'raspberry_pi_pico' from the 'Board ID:raspberry_pi_pico' line of boot_out.txt
+def board_id(boot_out):
+	with open(boot_out,'r') as f:
+		for line in f:
+			if line.startswith('Board ID:'):
+				return line[len('Board ID:'):].strip()
+	return None
+
+class Calibration_Cache():
+	def __init__(self,path=DEFAULT_PATH):
+		self.path = path
+		self.data = self._read()
+		# lab.py runs a station per thread, all on one cache.
+		self._lock = threading.Lock()
+
+	def _read(self):
+		try:
+			with open(self.path,'r') as f:
+				return loads(f.read())
+		except (OSError, ValueError):
+			return {}
+
+	def _write(self):
+		# Write then rename, so a crash doesn't leave half a file.
+		temp = self.path + '.tmp'
+		with self._lock:
+			with open(temp,'w') as f:
+				f.write(dumps(self.data,indent=1,sort_keys=True))
+			replace(temp,self.path)
+
+	def save(self,key,entry):
+		self.data[key] = entry
+		self._write()
+
+	def invalidate(self,key):
+		if (self.data.pop(key,None) is not None):
+			self._write()
+
+	# Keep a 'CAL:' line from the RP2040. Returns True if it was one.
+	def update_from_line(self,line):
+		line = line.strip()
+		if (not line.startswith(PREFIX)):
+			return False
+		message = loads(line[len(PREFIX):])
+		if (message['calibration'] is None):
+			self.invalidate(message['key'])
+		else:
+			self.save(message['key'],message['calibration'])
+		return True
+
+	# Entry for an exact key, or for a Board ID when only one board of that kind has been seen.
+	def lookup(self,key):
+		if (key in self.data):
+			return self.data[key]
+		matches = [k for k in self.data if k.split(':')[0] == key]
+		if (len(matches) == 1):
+			return self.data[matches[0]]
+		return None
+
+
+if __name__ == '__main__':
+	import sys
+	if (len(sys.argv) < 2):
+		print('usage: calibration_cache.py <boot_out.txt> [invalidate]')
+		sys.exit(1)
+	cache = Calibration_Cache()
+	board = board_id(sys.argv[1])
+	if (board is None):
+		print('No "Board ID:" line in ' + sys.argv[1] + '.')
+		sys.exit(1)
+	if (len(sys.argv) > 2) and (sys.argv[2] == 'invalidate'):
+		for key in [k for k in cache.data if k.split(':')[0] == board]:
+			cache.invalidate(key)
+	print(board + ': ' + dumps(cache.lookup(board)))
@@ -0,0 +1,92 @@
+# US Naval Academy
+# Robotics and Control TSD
+#
+# Host-side decoder for the 'BIN:' telemetry frames from python/telemetry.py.
+# Unit conversion is done on whole arrays instead of per sample on the RP2040.
+#
+# ex:
+# 	run = decode_line(line)
+# 	run['position']		rad, numpy float64
+# 	run['time']			s since the first sample, numpy float64
+#
+
+from struct import unpack_from, calcsize
+from binascii import a2b_base64, crc32
+import numpy as np
+
+# Must match python/telemetry.py
+MAGIC = b'Q305'
+VERSION = 1
+FLAG_CRC32 = 0x01
+HEADER = '<4sBBIfq'
+HEADER_SIZE = calcsize(HEADER)
+PREFIX = 'BIN:'
+
+class Telemetry_Error(ValueError):
+	pass
+
+def checksum(data,flags):
+	if (flags & FLAG_CRC32):
+		return crc32(data) & 0xffffffff
+	return int(np.frombuffer(data,dtype=np.uint8).sum()) & 0xffffffff
+
+def decode_frame(frame):
+	frame = memoryview(frame)
+	if (len(frame) < HEADER_SIZE + 4):
+		raise Telemetry_Error('Frame too short: ' + str(len(frame)) + ' bytes.')
+	magic, version, flags, count, counts_per_rev, t0 = unpack_from(HEADER,frame,0)
+	if (magic != MAGIC) or (version != VERSION):
+		raise Telemetry_Error('Not a version ' + str(VERSION) + ' Q305 frame.')
+	end = HEADER_SIZE + 8*count
+	if (len(frame) != end + 4):
+		raise Telemetry_Error('Frame length does not match sample count ' + str(count) + '.')
+	(expected,) = unpack_from('<I',frame,end)
+	if (checksum(frame[:end],flags) != expected):
+		raise Telemetry_Error('Checksum mismatch.')
+
+	counts = np.frombuffer(frame,dtype='<i4',count=count,offset=HEADER_SIZE)
+	deltas = np.frombuffer(frame,dtype='<i4',count=count,offset=HEADER_SIZE + 4*count)
+	time_ns = np.cumsum(deltas,dtype=np.int64)
+	return {
+		'counts' : counts.astype(np.int64),
+		'time_ns' : time_ns + t0,
+		'position' : counts * (2*np.pi / counts_per_rev),
+		'time' : time_ns / 1e9,
+		'counts_per_rev' : counts_per_rev,
+		't0' : t0
+	}
+
+def decode_line(line):
+	if isinstance(line,bytes):
+		line = line.decode()
+	line = line.strip()
+	if (not line.startswith(PREFIX)):
+		raise Telemetry_Error('Not a telemetry line.')
+	return decode_frame(a2b_base64(line[len(PREFIX):]))
+
+# Every frame in an iterable of serial lines. LOG: and json lines are skipped.
+def decode_lines(lines):
+	runs = []
+	for line in lines:
+		if isinstance(line,bytes):
+			line = line.decode(errors='replace')
+		if line.startswith(PREFIX):
+			runs.append(decode_line(line))
+	return runs
+
+# Stitch the frames of a streamed run back into one run.
+# Each frame carries its own t0, so time is taken from the absolute ns timestamps.
+def join_frames(frames):
+	if (not frames):
+		raise Telemetry_Error('No frames to join.')
+	counts = np.concatenate([f['counts'] for f in frames])
+	time_ns = np.concatenate([f['time_ns'] for f in frames])
+	counts_per_rev = frames[0]['counts_per_rev']
+	return {
+		'counts' : counts,
+		'time_ns' : time_ns,
+		'position' : counts * (2*np.pi / counts_per_rev),
+		'time' : (time_ns - time_ns[0]) / 1e9,
+		'counts_per_rev' : counts_per_rev,
+		't0' : int(time_ns[0])
+	}
@@ -0,0 +1,337 @@
+# US Naval Academy
+# Robotics and Control TSD
+#
+# Python host client for the RP2040, same API as matlab/ew305.m.
+#
+# Reads are framed by the 'LOG: begin' / 'LOG: end' lines from Quanser_305.run_controller(),
+# so send_commands() returns as soon as the last sample is in, instead of pausing
+# runtime + 1 seconds and polling. begin carries the sample count, so the data goes straight
+# into preallocated numpy arrays.
+#
+# ex:
+# 	a = ew305('/dev/ttyACM0')			or ew305(15) for COM15
+# 	a.send_commands(10, 1.0)			target rad/s, runtime s, then Kp, Ki, Kd, bias, rate
+# 	a.data['time'], a.data['position']	s, rad, numpy float64
+# 	a.send_batch([{'Kp' : 9.42e-8}, {'Kp' : 1.9e-7}])		list of data, one per run
+#
+# With a read-only CIRCUITPY the board can't keep its own calibration, pass a host side cache:
+# 	a = ew305('/dev/ttyACM0', calibration_cache=Calibration_Cache())
+# CAL: lines the board prints are kept in it, and at connect the board gets its cached biases
+# back if it came up uncalibrated, so find_bias() doesn't have to run again after a restart.
+#
+
+from json import loads, dumps
+from time import monotonic, sleep
+import numpy as np
+import serial
+
+import decode_telemetry
+
+LOG = 'LOG:'
+BEGIN = 'LOG: begin '
+END = 'LOG: end '
+
+class Serial_Timeout(TimeoutError):
+	pass
+
+class ew305():
+	def __init__(self,port,**kwargs):
+		# Setup default values.
+		buffer = {
+			'target' : 0,			# rad/s
+			'Kp' : 9.42e-8,
+			'Ki' : 1.256e-6,
+			'Kd' : 3.14e-11,
+			'runtime' : 1.0,		# s
+			'bias' : 0,				# x / 511, or 'auto'
+			'rate' : 500,			# Hz
+			'format' : 'json',		# 'json', 'binary' or 'stream'
+			'baudrate' : 115200,
+			'timeout' : 0.5,		# s per readline
+			'margin' : 5,			# s past runtime before giving up on a run
+			'verbose' : True,		# print LOG lines, like ew305.m
+			'calibration_cache' : None	# calibration_cache.Calibration_Cache, see above
+		}
+		for arg in buffer:
+			buffer[arg] = kwargs.get(arg,buffer[arg])
+		self.target = buffer['target']
+		self.Kp = buffer['Kp']
+		self.Ki = buffer['Ki']
+		self.Kd = buffer['Kd']
+		self.runtime = buffer['runtime']
+		self.bias = buffer['bias']
+		self.rate = buffer['rate']
+		self.format = buffer['format']
+		self.margin = buffer['margin']
+		self.verbose = buffer['verbose']
+		self.calibration_cache = buffer['calibration_cache']
+		self.calibration = None		# last calibration state line, ie {'key' : ..., 'calibrated' : True, ...}
+
+		if isinstance(port,int):
+			port = 'COM' + str(port)
+		self.com_port = port
+		self.serial_device = serial.Serial(port,buffer['baudrate'],timeout=buffer['timeout'])
+		self.log = []
+		self.data = None
+		self.flush()
+		if self.calibration_cache:
+			self.sync_calibration()
+
+	def close(self):
+		if self.serial_device:
+			self.serial_device.close()
+			self.serial_device = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,*args):
+		self.close()
+
+	def flush(self):
+		self.serial_device.reset_input_buffer()
+
+	# Same keystrokes as ew305.m: ctrl-c then ctrl-d, soft reset.
+	# Not needed between experiments any more, only to recover the device.
+	def reset_rp2040(self):
+		self.serial_device.write(b'\x03')
+		sleep(0.1)
+		self.serial_device.write(b'\x04')
+		# CircuitPython's start up banner isn't json.
+		sleep(0.5)
+		self.flush()
+
+	def _readline(self,deadline):
+		while True:
+			line = self.serial_device.readline()
+			if line:
+				return line.decode('utf-8','replace').strip()
+			if (monotonic() > deadline):
+				raise Serial_Timeout('No end of run from ' + str(self.com_port) + '.')
+
+	def _log(self,line):
+		self.log.append(line)
+		if self.verbose:
+			print(line)
+		if self.calibration_cache:
+			self.calibration_cache.update_from_line(line)
+
+	# Non-run command, ie a.command('calibrate'). Every command ends with the calibration state line,
+	# 'LOG: {"key": ..., "calibrated": ...}', returned as a dict. find_bias() takes a while, hence timeout.
+	def command(self,name,timeout=30,**fields):
+		fields['command'] = name
+		self.write(fields)
+		deadline = monotonic() + timeout
+		while True:
+			line = self._readline(deadline)
+			self._log(line)
+			if line.startswith(LOG + ' {'):
+				state = loads(line[len(LOG):])
+				if ('calibrated' in state):
+					self.calibration = state
+					return state
+
+	# The board's calibration state, after sending it the cached biases if it has none.
+	def sync_calibration(self):
+		state = self.command('calibration')
+		if (not state['calibrated']) and ('key' in state):
+			entry = self.calibration_cache.lookup(state['key'])
+			if entry:
+				state = self.command('load_calibration',calibration=entry)
+		return state
+
+	def commands(self):
+		return {
+			'target' : self.target,
+			'Kp' : self.Kp,
+			'Ki' : self.Ki,
+			'Kd' : self.Kd,
+			'time_limit' : self.runtime,
+			'bias' : self.bias,
+			'rate' : self.rate,
+			'format' : self.format
+		}
+
+	# a.send_commands(target,runtime,Kp,Ki,Kd,bias,rate)
+	# 	At least 'target' must be sent, same order as ew305.m.
+	def send_commands(self,target,runtime=None,Kp=None,Ki=None,Kd=None,bias=None,rate=None):
+		self.target = target
+		for name, value in (('runtime',runtime),('Kp',Kp),('Ki',Ki),('Kd',Kd),('bias',bias),('rate',rate)):
+			if (value is not None):
+				setattr(self,name,value)
+		self.write(self.commands())
+		self.data = self.read_run(self.runtime)
+		return self.data
+
+	# List of parameter sets (intake keys, ie 'Kp', 'time_limit'), run back to back on the device.
+	# Returns a list of data, one per run, also left in self.data.
+	def send_batch(self,batch):
+		runtime = sum([params.get('time_limit',self.runtime) for params in batch])
+		self.write(batch)
+		deadline = monotonic() + runtime + self.margin*len(batch)
+		self.data = [self.read_run(0,deadline) for _ in batch]
+		return self.data
+
+	def write(self,message):
+		self.serial_device.write((dumps(message) + '\n').encode('utf-8'))
+
+	# Read one framed run. LOG lines before it (ie from the last run) are logged and skipped.
+	# A run the device refused comes back empty, its 'LOG: Error' line is in self.log.
+	def read_run(self,runtime,deadline=None):
+		if (deadline is None):
+			deadline = monotonic() + runtime + self.margin
+		while True:
+			line = self._readline(deadline)
+			if line.startswith(BEGIN):
+				begin = loads(line[len(BEGIN):])
+				break
+			self._log(line)
+			# Firmware from before refusals were framed sends end without begin.
+			if line.startswith(END):
+				return {'position' : np.empty(0), 'time' : np.empty(0)}
+
+		if (begin['format'] == 'json'):
+			return self._read_json(begin['samples'],deadline)
+		return self._read_binary(begin,deadline)
+
+	def _read_json(self,count,deadline):
+		position = np.empty(count)
+		time = np.empty(count)
+		i = 0
+		while True:
+			line = self._readline(deadline)
+			if line.startswith(END):
+				break
+			if line.startswith(LOG):
+				self._log(line)
+				continue
+			sample = loads(line)
+			if (i < count):
+				position[i] = sample['position']
+				time[i] = sample['time']
+			i += 1
+		if (i != count):
+			self._log('LOG: host: expected ' + str(count) + ' samples, got ' + str(i))
+			position = position[:i]
+			time = time[:i]
+		return {'position' : position, 'time' : time}
+
+	# 'binary' is one 'BIN:' frame, 'stream' is several.
+	def _read_binary(self,begin,deadline):
+		frames = []
+		while True:
+			line = self._readline(deadline)
+			if line.startswith(END):
+				end = loads(line[len(END):])
+				break
+			if line.startswith(decode_telemetry.PREFIX):
+				frames.append(decode_telemetry.decode_line(line))
+			else:
+				self._log(line)
+		if (not frames):
+			return {'position' : np.empty(0), 'time' : np.empty(0)}
+		data = decode_telemetry.join_frames(frames)
+		if (len(data['time']) != end['samples']):
+			self._log('LOG: host: expected ' + str(end['samples']) + ' samples, got ' + str(len(data['time'])))
+		return data
+
+
+
+
+###################################
+######### Testing Section #########
+###################################
+
+# Host side self check against host/fake_device.py, no RP2040 needed.
+# ex:	python3 ew305.py
+def self_test(runs=3,runtime=1.0,rate=500):
+	from fake_device import Fake_Device
+	worst = 0
+	with Fake_Device() as device:
+		a = ew305(device.port,verbose=False)
+		for fmt in ('json','binary','stream'):
+			a.format = fmt
+			for _ in range(runs):
+				start = monotonic()
+				data = a.send_commands(10,runtime,rate=rate)
+				elapsed = monotonic() - start
+				expected = int(runtime*rate) + 1
+				ok = (len(data['time']) == expected) and (np.all(np.diff(data['time']) > 0))
+				worst = max(worst,elapsed - runtime)
+				print('LOG: ' + fmt + ': ' + str(len(data['time'])) + ' samples in ' + ('%0.3f' % elapsed) + ' s, ' + ('ok' if ok else 'FAIL'))
+				if (not ok):
+					return False
+		batch = a.send_batch([{'time_limit' : 0.2}, {'time_limit' : 0.3}])
+		print('LOG: batch: ' + str([len(data['time']) for data in batch]) + ' samples')
+		a.close()
+	print('LOG: PASS, worst overhead past runtime ' + ('%0.3f' % worst) + ' s (ew305.m waits 1.1 s or more)')
+	return True
+
+# Replays host/sim_transcript.txt, recorded off the sim with
+# 	SIM_VIRTUAL_CLOCK=1 PYTHONPATH=../sim python3 code.py < commands.txt > ../host/sim_transcript.txt
+# one run per command below, in the same order: json, binary, stream, a run refused for being
+# over 10 s, then a batch of two.
+# ex:	python3 ew305.py
+REPLAY = [
+	({'format' : 'json'}, 103),
+	({'format' : 'binary'}, 103),
+	({'format' : 'stream'}, 103),
+	({'format' : 'json', 'runtime' : 11}, 0),
+	([{'target' : 5, 'time_limit' : 0.1}, {'target' : 20, 'time_limit' : 0.1}], [53, 53])
+]
+def replay_test(transcript=None):
+	import os
+	from fake_device import Fake_Device
+	if (transcript is None):
+		transcript = os.path.join(os.path.dirname(os.path.abspath(__file__)),'sim_transcript.txt')
+	ok = True
+	with Fake_Device(transcript=transcript,speed=50) as device:
+		a = ew305(device.port,verbose=False,runtime=0.2)
+		for settings, expected in REPLAY:
+			if isinstance(settings,list):
+				got = [len(data['time']) for data in a.send_batch(settings)]
+			else:
+				a.format = settings['format']
+				data = a.send_commands(10,settings.get('runtime',0.2))
+				got = len(data['time'])
+			ok = ok and (got == expected)
+			print('LOG: ' + str(settings) + ': ' + str(got) + ' samples, expected ' + str(expected))
+		refused = any([line.startswith('LOG: Error') for line in a.log])
+		print('LOG: refusal logged: ' + str(refused))
+		a.close()
+	ok = ok and refused
+	print('LOG: ' + ('PASS' if ok else 'FAIL'))
+	return ok
+
+# A board that can't save its calibration: the first connect calibrates and the CAL: line goes to
+# the host cache, after a restart (a new Fake_Device) the biases come back without find_bias().
+# ex:	python3 ew305.py
+def calibration_test():
+	import os
+	import tempfile
+	from fake_device import Fake_Device
+	from calibration_cache import Calibration_Cache
+	with tempfile.TemporaryDirectory() as folder:
+		cache = Calibration_Cache(os.path.join(folder,'calibration.json'))
+		with Fake_Device() as device:
+			a = ew305(device.port,verbose=False,calibration_cache=cache)
+			before = a.calibration['calibrated']
+			measured = a.command('calibrate')
+			a.close()
+		with Fake_Device() as device:
+			a = ew305(device.port,verbose=False,calibration_cache=cache)
+			after = a.calibration
+			a.close()
+		with Fake_Device() as device:
+			a = ew305(device.port,verbose=False,calibration_cache=Calibration_Cache(cache.path))
+			from_file = a.calibration['calibrated']
+			a.close()
+	ok = (not before) and after['calibrated'] and (after['motor_bias'] == measured['motor_bias']) and (after['motor_bias_negative'] == measured['motor_bias_negative']) and from_file
+	print('LOG: restart: ' + dumps(after) + ', ' + ('PASS' if ok else 'FAIL'))
+	return ok
+
+
+if __name__ == '__main__':
+	self_test()
+	replay_test()
+	calibration_test()
@@ -0,0 +1,246 @@
+# US Naval Academy
+# Robotics and Control TSD
+#
+# Fake RP2040 on a pseudo-terminal, for trying host code without a Quanser 305.
+#
+# Speaks the same serial protocol as code.py: json intake lines in, LOG / json / BIN lines out,
+# framed by 'LOG: begin' and 'LOG: end'. Open Fake_Device().port with pyserial like any COM port.
+#
+# Calibration commands behave like a board with a read-only CIRCUITPY: calibrate prints a 'CAL:' line
+# and nothing survives a new Fake_Device, load_calibration takes it back from the host.
+#
+# Output is either synthesized (a first order step response at the requested target and rate)
+# or replayed from a transcript captured off a real device or the sim:
+# 	PYTHONPATH=../sim python3 code.py < commands.txt > transcript.txt
+# 	Fake_Device(transcript='transcript.txt')		one run per command, in order, then repeats
+#
+# ex:
+# 	with Fake_Device() as device:
+# 		a = ew305(device.port)
+#
+
+import os
+import tty
+import threading
+from json import loads, dumps
+from math import exp, pi
+from struct import pack
+from binascii import b2a_base64, crc32
+from time import monotonic, sleep
+
+import decode_telemetry
+
+BANNER = [
+	'Adafruit CircuitPython 7.0.0-602-gdf3f54f24 on 2021-10-31; Raspberry Pi Pico with rp2040',
+	'code.py output:',
+	'LOG: Initializing SPI bus. Attempt # 1',
+	'LOG: SPI bus Initialized.',
+	'LOG: Initializing AD5293 digital potentiometer...'
+]
+
+# Same layout as python/telemetry.py
+def encode_line(counts,times_ns,counts_per_rev):
+	count = len(counts)
+	t0 = times_ns[0]
+	deltas = [t - last for t, last in zip(times_ns,[t0] + times_ns[:-1])]
+	body = pack(decode_telemetry.HEADER,decode_telemetry.MAGIC,decode_telemetry.VERSION,decode_telemetry.FLAG_CRC32,count,counts_per_rev,t0)
+	body += pack('<' + str(count) + 'i',*counts) + pack('<' + str(count) + 'i',*deltas)
+	body += pack('<I',crc32(body) & 0xffffffff)
+	return decode_telemetry.PREFIX + b2a_base64(body).decode().strip()
+
+# Runs in a transcript, split after each 'LOG: end' line.
+def read_transcript(path):
+	runs = []
+	run = []
+	with open(path,'r') as f:
+		for line in f:
+			line = line.rstrip('\n')
+			run.append(line)
+			if line.startswith('LOG: end '):
+				runs.append(run)
+				run = []
+	return runs
+
+
+class Fake_Device():
+	def __init__(self,**kwargs):
+		# Setup default values.
+		buffer = {
+			'transcript' : None,	# path, replay these runs instead of synthesizing
+			'speed' : 1.0,			# run time multiplier, >1 finishes runs early
+			'tau' : 0.05,			# s
+			'counts_per_rev' : 2000,
+			'stream_chunk' : 64,
+			'key' : 'raspberry_pi_pico:fake',	# calibration.board_key()
+			'bias' : (0.055, -0.051)			# what find_bias() finds
+		}
+		for arg in buffer:
+			buffer[arg] = kwargs.get(arg,buffer[arg])
+		self.speed = buffer['speed']
+		self.tau = buffer['tau']
+		self.counts_per_rev = buffer['counts_per_rev']
+		self.stream_chunk = buffer['stream_chunk']
+		self.key = buffer['key']
+		self.bias = buffer['bias']
+		self.calibration = None
+		self.runs = read_transcript(buffer['transcript']) if buffer['transcript'] else None
+		self.replayed = 0
+		self.control_data = {
+			'target' : 10,
+			'time_limit' : 1,
+			'rate' : 500,
+			'format' : 'json'
+		}
+		self.commands = 0
+
+		self.master, self.slave = os.openpty()
+		tty.setraw(self.slave)
+		self.port = os.ttyname(self.slave)
+		self._running = True
+		self._thread = threading.Thread(target=self._serve,daemon=True)
+		self._thread.start()
+
+	def close(self):
+		self._running = False
+		for fd in (self.master, self.slave):
+			try:
+				os.close(fd)
+			except OSError:
+				pass
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,*args):
+		self.close()
+
+	def _write(self,lines):
+		data = ('\r\n'.join(lines) + '\r\n').encode('utf-8')
+		while data:
+			try:
+				written = os.write(self.master,data)
+			except OSError:
+				# Closed mid run, nobody is listening any more.
+				if (not self._running):
+					return
+				raise
+			data = data[written:]
+
+	def _serve(self):
+		pending = b''
+		while self._running:
+			try:
+				chunk = os.read(self.master,4096)
+			except OSError:
+				return
+			pending += chunk
+			# ctrl-c, ctrl-d: soft reset.
+			if (b'\x04' in pending):
+				pending = pending[pending.rindex(b'\x04') + 1:]
+				self._write(BANNER)
+				continue
+			pending = pending.replace(b'\x03',b'')
+			while (b'\n' in pending):
+				line, pending = pending.split(b'\n',1)
+				line = line.strip()
+				if line:
+					self._handle(line.decode('utf-8','replace'))
+
+	def _handle(self,line):
+		self.commands += 1
+		try:
+			message = loads(line)
+		except ValueError:
+			self._write(['LOG: DataType Error: input was not in correct json format.', 'LOG: ' + line])
+			return
+		if isinstance(message,list):
+			for run, params in enumerate(message):
+				self._write(['LOG: run ' + dumps({'run' : run, 'of' : len(message)})])
+				self._run(params,run)
+			self._write(['LOG: batch complete ' + dumps({'runs' : len(message)})])
+		elif ('command' in message):
+			self._command(message)
+		else:
+			for key in self.control_data:
+				self.control_data[key] = message.get(key,self.control_data[key])
+			self._run({},None)
+
+	# Same commands and state line as code.py's run_command().
+	def _command(self,message):
+		command = message['command']
+		lines = []
+		if (command in ('calibrate', 'recalibrate')):
+			if (command == 'recalibrate') or (not self.calibration):
+				self.calibration = {'motor_bias' : self.bias[0], 'motor_bias_negative' : self.bias[1]}
+				lines.append('CAL: ' + dumps({'key' : self.key, 'calibration' : self.calibration}))
+		elif (command == 'invalidate_calibration'):
+			self.calibration = None
+			lines.append('CAL: ' + dumps({'key' : self.key, 'calibration' : None}))
+		elif (command == 'load_calibration'):
+			self.calibration = message.get('calibration')
+		elif (command != 'calibration'):
+			self._write(['LOG: unknown command: ' + str(command)])
+			return
+		calibration = self.calibration or {}
+		lines.append('LOG: ' + dumps({
+			'key' : self.key,
+			'calibrated' : bool(self.calibration),
+			'motor_bias' : calibration.get('motor_bias',0),
+			'motor_bias_negative' : calibration.get('motor_bias_negative',0),
+			'counts_per_rev' : self.counts_per_rev
+		}))
+		self._write(lines)
+
+	def _run(self,params,run):
+		settings = dict(self.control_data)
+		settings.update(params)
+		if self.runs:
+			sleep(settings['time_limit'] / self.speed)
+			self._write(self.runs[self.replayed % len(self.runs)])
+			self.replayed += 1
+			return
+
+		rate = settings['rate']
+		count = int(settings['time_limit'] * rate) + 1
+		cps = settings['target'] * self.counts_per_rev / (2*pi)
+		tau = self.tau
+		counts = []
+		times_ns = []
+		for i in range(count):
+			t = i / rate
+			counts.append(int(cps * (t - tau*(1 - exp(-t / tau)))))
+			times_ns.append(int(t * 10**9))
+
+		fmt = settings['format']
+		tag = {} if (run is None) else {'run' : run}
+		def marker(name,**fields):
+			fields['format'] = fmt
+			fields.update(tag)
+			return 'LOG: ' + name + ' ' + dumps(fields)
+
+		start = monotonic()
+		if (fmt == 'stream'):
+			self._write([marker('begin',expected=count)])
+			chunk = self.stream_chunk
+			for first in range(0,count,chunk):
+				# Frames go out as the samples would have been taken.
+				due = start + times_ns[min(first + chunk,count) - 1] / 10**9 / self.speed
+				delay = due - monotonic()
+				if (delay > 0):
+					sleep(delay)
+				self._write([encode_line(counts[first:first + chunk],times_ns[first:first + chunk],self.counts_per_rev)])
+			lines = [marker('end',samples=count,dropped=0)]
+		else:
+			sleep(settings['time_limit'] / self.speed)
+			lines = [marker('begin',samples=count)]
+			if (fmt == 'binary'):
+				lines.append(encode_line(counts,times_ns,self.counts_per_rev))
+			else:
+				sample = dict(tag)
+				for c, t in zip(counts,times_ns):
+					sample['position'] = c * 2*pi / self.counts_per_rev
+					sample['time'] = t / 10**9
+					lines.append(dumps(sample))
+			lines.append(marker('end',samples=count))
+		lines.append('LOG: final err: 0.00%')
+		self._write(lines)
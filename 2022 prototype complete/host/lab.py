@@ -0,0 +1,178 @@
+# US Naval Academy
+# Robotics and Control TSD
+#
+# Many Quanser 305 stations at once, one RP2040 per serial port.
+#
+# Each Station wraps an ew305 client. The orchestrator is asyncio: one worker coroutine per
+# station pulls experiments off a shared queue, so a station that's busy (or slow, or stuck
+# until its timeout) never holds up the others. Serial reads are blocking pyserial calls, run
+# with asyncio.to_thread(), since asyncio can't watch a COM port on Windows.
+#
+# Experiments are intake dicts, same keys as the json line code.py takes:
+# 	{'target' : 10, 'time_limit' : 1, 'Kp' : 9.42e-8, 'Ki' : 1.256e-6, 'Kd' : 0}
+#
+# ex:
+# 	lab = Lab(['/dev/ttyACM0', '/dev/ttyACM1'])		or [15, 16] for COM15, COM16
+# 	results = lab.run_all(experiments)				shared queue, any free station
+# 	results = lab.run_all({'/dev/ttyACM0' : [...], '/dev/ttyACM1' : [...]})	one queue per port
+# 	lab.report()									experiments/hour, per station counts
+#
+# results[i] is for experiments[i]: {'experiment', 'station', 'data', 'error', 'seconds'}
+#
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+from ew305 import ew305
+
+class Station():
+	def __init__(self,port,**kwargs):
+		self.port = port
+		kwargs.setdefault('verbose',False)
+		self.client = ew305(port,**kwargs)
+		self.completed = 0
+		self.failed = 0
+		self.busy_seconds = 0.0
+
+	def close(self):
+		self.client.close()
+
+	# Blocking, one experiment start to 'LOG: end'.
+	def run(self,experiment):
+		client = self.client
+		client.write(experiment)
+		return client.read_run(experiment.get('time_limit',client.runtime))
+
+
+class Lab():
+	def __init__(self,ports,**kwargs):
+		self.stations = [Station(port,**kwargs) for port in ports]
+		self.elapsed = 0.0
+		self.on_result = None		# callback(result), called as each experiment finishes
+
+	def close(self):
+		for station in self.stations:
+			station.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,*args):
+		self.close()
+
+	async def _worker(self,station,queue,results):
+		while True:
+			try:
+				index, experiment = queue.get_nowait()
+			except asyncio.QueueEmpty:
+				return
+			start = monotonic()
+			result = {'experiment' : experiment, 'station' : station.port, 'data' : None, 'error' : None}
+			try:
+				result['data'] = await asyncio.to_thread(station.run,experiment)
+				station.completed += 1
+			except Exception as e:
+				# The device may still be mid run, start it over before the next one.
+				result['error'] = repr(e)
+				station.failed += 1
+				await asyncio.to_thread(station.client.reset_rp2040)
+			result['seconds'] = monotonic() - start
+			station.busy_seconds += result['seconds']
+			results[index] = result
+			if self.on_result:
+				self.on_result(result)
+
+	# experiments: a list for one shared queue, or {port : list} for a queue per station.
+	async def run(self,experiments):
+		if isinstance(experiments,dict):
+			# Nothing would ever run a queue for a port that isn't a station, its results would stay None.
+			unknown = [port for port in experiments if (port not in [station.port for station in self.stations])]
+			if unknown:
+				raise ValueError('No station on port ' + ', '.join([str(port) for port in unknown]) + '.')
+			count = sum([len(queue) for queue in experiments.values()])
+			results = [None] * count
+			queues = {}
+			index = 0
+			for port, queue in experiments.items():
+				queues[port] = asyncio.Queue()
+				for experiment in queue:
+					queues[port].put_nowait((index, experiment))
+					index += 1
+			workers = [self._worker(station,queues[station.port],results) for station in self.stations if (station.port in queues)]
+		else:
+			results = [None] * len(experiments)
+			shared = asyncio.Queue()
+			for index, experiment in enumerate(experiments):
+				shared.put_nowait((index, experiment))
+			workers = [self._worker(station,shared,results) for station in self.stations]
+		# A thread per station, the default executor is capped at a few per cpu.
+		asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=len(self.stations)))
+		start = monotonic()
+		await asyncio.gather(*workers)
+		self.elapsed += monotonic() - start
+		return results
+
+	def run_all(self,experiments):
+		return asyncio.run(self.run(experiments))
+
+	def report(self):
+		completed = sum([station.completed for station in self.stations])
+		failed = sum([station.failed for station in self.stations])
+		return {
+			'completed' : completed,
+			'failed' : failed,
+			'seconds' : self.elapsed,
+			'experiments_per_hour' : (3600 * completed / self.elapsed) if self.elapsed else 0.0,
+			'stations' : {
+				str(station.port) : {
+					'completed' : station.completed,
+					'failed' : station.failed,
+					'utilization' : (station.busy_seconds / self.elapsed) if self.elapsed else 0.0
+				} for station in self.stations
+			}
+		}
+
+
+
+
+###################################
+######### Testing Section #########
+###################################
+
+# N fake stations on pseudo-terminals (host/fake_device.py), no hardware needed.
+# One station is slowed down to show the others don't wait on it.
+# ex:	python3 lab.py
+def demo(stations=4,experiments=24,runtime=0.5):
+	from fake_device import Fake_Device
+	from json import dumps
+	devices = [Fake_Device() for _ in range(stations)]
+	devices[0].speed = 0.5
+	queue = [{'target' : 5 + (i % 6), 'time_limit' : runtime, 'Kp' : 9.42e-8 * (1 + i)} for i in range(experiments)]
+	ok = True
+	try:
+		with Lab([device.port for device in devices]) as lab:
+			results = lab.run_all(queue)
+			report = lab.report()
+			# A queue for a port that isn't a station has to fail up front.
+			try:
+				lab.run_all({'/dev/no_station' : queue[:1]})
+				ok = False
+			except ValueError as e:
+				print('LOG: ' + str(e))
+		for result in results:
+			expected = int(result['experiment']['time_limit'] * 500) + 1
+			if (result['error']) or (len(result['data']['time']) != expected):
+				ok = False
+		serial_hours = experiments * runtime / 3600
+		print('LOG: ' + dumps(report,indent=1))
+		print('LOG: one station back to back would top out near ' + ('%0.0f' % (experiments / serial_hours)) + ' experiments/hour')
+	finally:
+		for device in devices:
+			device.close()
+	print('LOG: ' + ('PASS' if ok else 'FAIL'))
+	return ok
+
+
+if __name__ == '__main__':
+	demo()
@@ -0,0 +1,202 @@
+# US Naval Academy
+# Robotics and Control TSD
+#
+# Monte Carlo robustness of one gain set across station to station plant variation.
+#
+# Draws thousands of plants (gain, time constant, deadband either way, encoder counts per rev),
+# runs the same gains on every one with batch_sim, and reports the spread of
+# 	settle		s, inf if it never settles
+# 	overshoot	fraction of target
+# 	final_error	runit()'s "final err", last error / target (rad/s of error for a 0 target)
+# Draws are split into chunks for a ProcessPoolExecutor. The plants and the results live in
+# multiprocessing.shared_memory arrays, workers attach by name and write their rows in place,
+# so nothing but a few ints goes through the pool's pipes.
+#
+# ex:
+# 	python3 robustness.py '{"Kp": 2.517e-07, "Ki": 3.3e-06, "Kd": 0, "bias": 24}' --draws 5000
+# 	report = Robustness(draws=5000).run({'Kp' : 9.42e-8, 'Ki' : 1.256e-6, 'Kd' : 3.14e-11})
+#
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from json import dumps
+import os
+import numpy as np
+
+import batch_sim
+
+PLANT = ('gain', 'tau', 'deadband', 'deadband_negative', 'counts_per_rev')
+RESULTS = ('settle', 'overshoot', 'final_error', 'rise', 'iae')
+COUNTS_PER_REV = (1250, 2000, 2500, 3040, 3050, 3080, 3140, 5000)		# dev/code_305.py's candidates and code.py's
+RANGES = {
+	'gain' : (45.0, 75.0),			# rad/s at full scale
+	'tau' : (0.03, 0.08),			# s
+	'deadband' : (15 / 512, 45 / 512),
+	'asymmetry' : (0.8, 1.25)		# deadband_negative / deadband
+}
+GAINS = ('Kp', 'Ki', 'Kd', 'bias', 'target', 'rate', 'law')
+
+# (draws, len(PLANT)) uniform draws inside 'ranges', counts per rev picked from 'counts_per_rev'.
+def draw_plants(draws,seed=None,ranges=None,counts_per_rev=COUNTS_PER_REV):
+	ranges = dict(RANGES, **(ranges or {}))
+	rng = np.random.default_rng(seed)
+	plants = np.empty((draws,len(PLANT)))
+	plants[:,0] = rng.uniform(*ranges['gain'],draws)
+	plants[:,1] = rng.uniform(*ranges['tau'],draws)
+	plants[:,2] = rng.uniform(*ranges['deadband'],draws)
+	plants[:,3] = plants[:,2] * rng.uniform(*ranges['asymmetry'],draws)
+	plants[:,4] = rng.choice(counts_per_rev,draws)
+	return plants
+
+def _attach(name,shape):
+	memory = shared_memory.SharedMemory(name=name)
+	return memory, np.ndarray(shape,dtype=np.float64,buffer=memory.buf)
+
+# Worker side: simulate rows [start, stop) of the shared plants, write the shared results.
+def _run_chunk(plants_name,results_name,draws,start,stop,settings):
+	plants_memory, plants = _attach(plants_name,(draws,len(PLANT)))
+	results_memory, results = _attach(results_name,(draws,len(RESULTS)))
+	try:
+		configs = {name : plants[start:stop,i] for i, name in enumerate(PLANT)}
+		run = batch_sim.simulate(configs,**settings)
+		scores = batch_sim.score(run)
+		scores['final_error'] = run['final_error']
+		for i, name in enumerate(RESULTS):
+			results[start:stop,i] = scores[name]
+		# Views have to go before the memory can close.
+		del plants, results, configs
+	finally:
+		plants_memory.close()
+		results_memory.close()
+	return stop - start
+
+
+class Robustness():
+	def __init__(self,**kwargs):
+		# Setup default values.
+		buffer = {
+			'draws' : 5000,
+			'seed' : None,
+			'ranges' : None,				# overrides for RANGES
+			'counts_per_rev' : COUNTS_PER_REV,
+			'firmware_counts_per_rev' : None,	# None: every station set up with its own encoder's
+			'time_limit' : 1.0,				# s
+			'band' : 0.05,					# settle band and pass limit on |final_error|, fraction (rad/s for a 0 target)
+			'workers' : os.cpu_count(),
+			'chunk' : 512					# draws per worker task
+		}
+		for arg in buffer:
+			buffer[arg] = kwargs.get(arg,buffer[arg])
+		self.draws = buffer['draws']
+		self.seed = buffer['seed']
+		self.ranges = buffer['ranges']
+		self.counts_per_rev = buffer['counts_per_rev']
+		self.firmware_counts_per_rev = buffer['firmware_counts_per_rev']
+		self.time_limit = buffer['time_limit']
+		self.band = buffer['band']
+		self.workers = buffer['workers']
+		self.chunk = buffer['chunk']
+		self.plants = None
+		self.results = None
+
+	# gains: intake keys, ie a tuner.py json line. Returns the report, raw rows in self.plants / self.results.
+	def run(self,gains):
+		settings = {name : gains[name] for name in GAINS if (name in gains)}
+		settings['time_limit'] = gains.get('time_limit',self.time_limit)
+		if self.firmware_counts_per_rev:
+			settings['firmware_counts_per_rev'] = self.firmware_counts_per_rev
+		plants = draw_plants(self.draws,self.seed,self.ranges,self.counts_per_rev)
+
+		plants_memory = shared_memory.SharedMemory(create=True,size=plants.nbytes)
+		results_memory = shared_memory.SharedMemory(create=True,size=self.draws*len(RESULTS)*8)
+		try:
+			shared = np.ndarray(plants.shape,dtype=np.float64,buffer=plants_memory.buf)
+			shared[:] = plants
+			results = np.ndarray((self.draws,len(RESULTS)),dtype=np.float64,buffer=results_memory.buf)
+			results[:] = np.nan
+			with ProcessPoolExecutor(max_workers=self.workers) as pool:
+				futures = [pool.submit(_run_chunk,plants_memory.name,results_memory.name,self.draws,start,min(start + self.chunk,self.draws),settings)
+					for start in range(0,self.draws,self.chunk)]
+				done = sum([future.result() for future in futures])
+			self.plants = plants
+			self.results = results.copy()
+			del shared, results
+		finally:
+			plants_memory.close()
+			plants_memory.unlink()
+			results_memory.close()
+			results_memory.unlink()
+		if (done != self.draws):
+			raise RuntimeError('Only ' + str(done) + ' of ' + str(self.draws) + ' draws came back.')
+		return self.report()
+
+	# Percentiles per result, pass fractions, and the plant the gains did worst on.
+	def report(self):
+		results = self.results
+		column = {name : results[:,i] for i, name in enumerate(RESULTS)}
+		settled = np.isfinite(column['settle'])
+		held = np.abs(column['final_error']) <= self.band
+		report = {'draws' : self.draws, 'settled' : float(settled.mean()), 'final_within_band' : float(held.mean())}
+		for name in ('settle', 'overshoot', 'final_error'):
+			values = column[name]
+			finite = values[np.isfinite(values)]
+			if (not finite.size):
+				report[name] = None
+				continue
+			p5, p50, p95 = np.percentile(finite,[5,50,95])
+			worst = finite[np.argmax(np.abs(finite))]
+			report[name] = {'p5' : float(p5), 'p50' : float(p50), 'p95' : float(p95), 'worst' : float(worst)}
+		# Worst: never settled, then the slowest to.
+		worst = int(np.argmax(np.where(settled, column['settle'], np.inf)))
+		report['worst_plant'] = {name : float(self.plants[worst,i]) for i, name in enumerate(PLANT)}
+		report['by_counts_per_rev'] = {
+			str(int(cpr)) : float(settled[self.plants[:,4] == cpr].mean()) for cpr in np.unique(self.plants[:,4])
+		}
+		return report
+
+
+
+
+###################################
+######### Testing Section #########
+###################################
+
+# The pool and shared memory path has to give the same rows as one simulate() of every draw.
+# ex:	python3 -c "import robustness; robustness.check()"
+def check(draws=1000,seed=305):
+	from time import perf_counter
+	gains = {'Kp' : 9.42e-8, 'Ki' : 1.256e-6, 'Kd' : 3.14e-11}
+	robustness = Robustness(draws=draws,seed=seed,chunk=128)
+	start = perf_counter()
+	robustness.run(gains)
+	elapsed = perf_counter() - start
+	plants = draw_plants(draws,seed)
+	run = batch_sim.simulate({name : plants[:,i] for i, name in enumerate(PLANT)},time_limit=robustness.time_limit,**gains)
+	scores = batch_sim.score(run)
+	scores['final_error'] = run['final_error']
+	ok = True
+	for i, name in enumerate(RESULTS):
+		if (not np.array_equal(robustness.results[:,i],scores[name])):
+			ok = False
+	print('LOG: ' + str(draws) + ' draws in ' + ('%0.2f' % elapsed) + ' s, ' + ('PASS' if ok else 'FAIL'))
+	return ok
+
+
+if __name__ == '__main__':
+	import argparse
+	from json import loads
+	from time import perf_counter
+	parser = argparse.ArgumentParser(description='Run one gain set over randomized plants, report the spread.')
+	parser.add_argument('gains',nargs='?',default='{"Kp": 9.42e-8, "Ki": 1.256e-6, "Kd": 3.14e-11}',help='json line, ie from tuner.py')
+	parser.add_argument('--draws',type=int,default=5000)
+	parser.add_argument('--seed',type=int,default=None)
+	parser.add_argument('--time_limit',type=float,default=1.0,help='s')
+	parser.add_argument('--firmware_counts_per_rev',type=int,default=None,help='counts per rev every station was told, default its own')
+	parser.add_argument('--workers',type=int,default=os.cpu_count())
+	args = parser.parse_args()
+
+	robustness = Robustness(draws=args.draws,seed=args.seed,time_limit=args.time_limit,firmware_counts_per_rev=args.firmware_counts_per_rev,workers=args.workers)
+	start = perf_counter()
+	report = robustness.run(loads(args.gains))
+	print('LOG: %d draws in %0.2f s' %(args.draws, perf_counter() - start))
+	print(dumps(report,indent=1))
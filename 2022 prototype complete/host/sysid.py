@@ -0,0 +1,421 @@
+# US Naval Academy
+# Robotics and Control TSD
+#
+# Plant identification from logged step responses, for batch_sim.py / tuner.py / robustness.py.
+#
+# Reads the {"position", "time"} lines from Quanser_305.print_results_json() (a transcript of the
+# serial port, BIN: frames work too), or a MATLAB a.data export (jsonencode(a.data) or
+# writetable(struct2table(a.data))), and fits the motor model of sim/motor.py:
+# 	u		= (code - 511.5) / 511.5
+# 	w_ss	= gain * (u - deadband)				u > deadband
+# 			= gain * (u + deadband_negative)	u < -deadband_negative, else 0
+# 	tau * dw/dt = w_ss - w						order 1
+# 	tau_electrical, tau							order 2, two lags in series
+# with w_ss seen 'delay' ticks late.
+#
+# The wiper codes aren't logged, so they're rebuilt by running the logged counts back through
+# the run's control law (batch_sim.replay()), which needs the json line the run was started with.
+# For a fixed tau, tau_electrical and delay, position is linear in gain, gain*deadband and
+# gain*deadband_negative, so those come from least squares on position (no noisy speed estimate),
+# solved for every run, every tau on a log grid and every delay at once. Deadband picks which
+# samples are outside it, so that's iterated a few times. Best tau is refined with a parabola.
+#
+# Deadband needs the drive to move. One closed loop run mostly sits at one drive level, so gain
+# and deadband (and tau and delay) can trade off; fit a station's runs at a few targets together
+# (station=) and they can't. A bias only run can't tell gain from deadband, pass deadband= to hold it.
+# deadband_negative needs the wiper to go in reverse (overshoot), otherwise it's reported the same
+# as deadband. A short electrical lag looks a lot like a tick or two of delay; with order 2, pass
+# max_delay=0 if the delay is known to be none.
+#
+# ex:
+# 	runs = load('transcript.txt')
+# 	fit = identify(runs, control={'target' : 10, 'Kp' : 9.42e-8, 'Ki' : 1.256e-6, 'Kd' : 3.14e-11}, station=[0]*len(runs))
+# 	tuner = Tuner(plant=plant(fit,0))
+# 	python3 sysid.py station1.txt station2.txt --control '[{"target": 5}, {"target": 10}, {"target": 20}]'
+#
+
+from json import loads, dumps
+import numpy as np
+
+import batch_sim
+import decode_telemetry
+
+TAU = 2*np.pi
+RESULTS = ('gain', 'tau', 'tau_electrical', 'deadband', 'deadband_negative', 'delay', 'rms')
+PLANT = ('gain', 'tau', 'deadband', 'deadband_negative')
+
+def _from_samples(samples):
+	return {
+		'position' : np.array([sample['position'] for sample in samples],dtype=np.float64),
+		'time' : np.array([sample['time'] for sample in samples],dtype=np.float64)
+	}
+
+# Runs in serial output, split on 'LOG: begin' / 'LOG: end', a new "run" tag or time starting over.
+def parse_lines(lines):
+	runs = []
+	samples = []
+	frames = []
+	tag = None
+	def close():
+		if frames:
+			runs.append(decode_telemetry.join_frames(frames))
+		elif samples:
+			runs.append(_from_samples(samples))
+		del samples[:]
+		del frames[:]
+	for line in lines:
+		line = line.strip()
+		if line.startswith('LOG: begin ') or line.startswith('LOG: end '):
+			close()
+		elif line.startswith(decode_telemetry.PREFIX):
+			frames.append(decode_telemetry.decode_line(line))
+		elif line.startswith('{'):
+			try:
+				sample = loads(line)
+			except ValueError:
+				continue
+			if ('position' not in sample) or ('time' not in sample):
+				continue
+			if samples and ((sample.get('run') != tag) or (sample['time'] < samples[-1]['time'])):
+				close()
+			tag = sample.get('run')
+			samples.append(sample)
+	close()
+	return runs
+
+def _from_csv(text):
+	lines = [line.strip() for line in text.splitlines() if line.strip()]
+	header = [name.strip().strip('"') for name in lines[0].split(',')]
+	data = np.array([[float(value) for value in line.split(',')] for line in lines[1:]])
+	return {'position' : data[:,header.index('position')], 'time' : data[:,header.index('time')]}
+
+# List of runs, {'position', 'time'} in rad and s, from any of the formats above.
+def load(path):
+	with open(path,'r') as f:
+		text = f.read()
+	stripped = text.lstrip()
+	if stripped.startswith('['):
+		data = loads(stripped)
+		if data and isinstance(data[0],list):
+			return [_from_samples(run) for run in data]
+		return [_from_samples(data)]
+	if stripped.startswith('position') or stripped.startswith('time') or stripped.startswith('"'):
+		return [_from_csv(stripped)]
+	return parse_lines(text.splitlines())
+
+# Runs padded to one (runs, samples) array. Padding repeats the last sample and isn't valid.
+def _pack(runs,counts_per_rev):
+	length = max([len(run['time']) for run in runs])
+	counts = np.zeros((len(runs),length))
+	time = np.zeros((len(runs),length))
+	valid = np.zeros((len(runs),length),dtype=bool)
+	for i, run in enumerate(runs):
+		m = len(run['time'])
+		if ('counts' in run):
+			c = np.asarray(run['counts'],dtype=np.float64)
+		else:
+			c = np.round(np.asarray(run['position']) * run.get('counts_per_rev',counts_per_rev) / TAU)
+		t = np.round(np.asarray(run['time']) * 10**9)
+		counts[i,:m] = c
+		counts[i,m:] = c[-1]
+		time[i,:m] = t - t[0]
+		time[i,m:] = time[i,m - 1]
+		valid[i,:m] = True
+	return counts, time, valid
+
+# One json line for every run, or a list of them as arrays. Keys missing from some runs
+# get simulate()'s default, same as a run that never set them.
+def _controls(control):
+	if isinstance(control,(list,tuple)):
+		defaults = batch_sim._setup(None,{},n=1)[0]
+		keys = []
+		for c in control:
+			keys += [key for key in c if (key not in keys)]
+		return {key : [c.get(key,defaults.get(key)) for c in control] for key in keys}
+	return dict(control or {})
+
+# Drive regressors, (runs, samples, 3): gain * them summed is w_ss.
+# With the deadband held there's one, u already past the deadband.
+# Deadbands are per run here, onehot (stations, runs) pools the reverse samples of a station.
+def _regressors(u,deadband,deadband_negative,held,onehot,min_support):
+	positive = u > deadband[:,None]
+	negative = u < -deadband_negative[:,None]
+	if held:
+		return (np.where(positive, u - deadband[:,None], 0.0) + np.where(negative, u + deadband_negative[:,None], 0.0))[:,:,None]
+	# Too few reverse samples to say anything about deadband_negative.
+	support = (onehot.T @ (onehot @ negative.sum(axis=1))) >= min_support
+	negative &= support[:,None]
+	return np.stack([u * (positive | negative), -1.0 * positive, 1.0 * negative],axis=2)
+
+# Position response to each regressor held between samples, starting from rest.
+# regressors (n, m, R), time (n, m) s, tau and tau_e (n, T), tau_e 0 for order 1. Returns (n, T, R, m).
+def _responses(regressors,time,tau,tau_e):
+	n, m, R = regressors.shape
+	out = np.zeros((n,tau.shape[1],R,m))
+	tau = tau[:,:,None]
+	tau_e = tau_e[:,:,None]
+	second = np.any(tau_e > 0)
+	theta = np.zeros(out.shape[:3])
+	x1 = np.zeros(out.shape[:3])
+	x2 = np.zeros(out.shape[:3])
+	for k in range(1,m):
+		h = (time[:,k] - time[:,k - 1])[:,None,None]
+		w = regressors[:,None,k - 1,:]
+		e2 = np.exp(-h / tau)
+		if second:
+			# Electrical lag x1 then mechanical x2, exact for a held input, tau_e != tau.
+			e1 = np.exp(-h / np.where(tau_e > 0, tau_e, 1.0))
+			a = x1 - w
+			c = np.where(tau_e > 0, a * tau_e / (tau_e - tau), 0.0)
+			b = x2 - w - c
+			theta = theta + w*h + b*tau*(1 - e2) + c*tau_e*(1 - e1)
+			x2 = w + b*e2 + c*e1
+			x1 = np.where(tau_e > 0, w + a*e1, w)
+		else:
+			theta = theta + w*h + (x2 - w)*tau*(1 - e2)
+			x2 = w + (x2 - w)*e2
+		out[:,:,:,k] = theta
+	return out
+
+# Least squares at one delay for every station and grid point, the normal equations of a
+# station's runs summed. Returns coefficients (stations, T, R) and rss (stations, T).
+def _solve(responses,y,weight,delay,onehot):
+	if delay:
+		phi = np.zeros(responses.shape)
+		phi[...,delay:] = responses[...,:-delay]
+	else:
+		phi = responses
+	a = np.einsum('gn,ntrm,ntsm,nm->gtrs',onehot,phi,phi,weight,optimize=True)
+	b = np.einsum('gn,ntrm,nm->gtr',onehot,phi,weight*y,optimize=True)
+	c = np.einsum('gtrs,gts->gtr',np.linalg.pinv(a),b)
+	rss = (onehot @ np.sum(weight*y*y,axis=1))[:,None] - np.einsum('gtr,gtr->gt',c,b)
+	return c, rss
+
+# Fits the runs of whole stations, station[i] is run i's index in 0..count-1.
+def _fit_chunk(counts,time,valid,codes,station,count,settings):
+	n = counts.shape[0]
+	onehot = (station[None,:] == np.arange(count)[:,None]).astype(np.float64)
+	cpr = settings['counts_per_rev']
+	time = time / 10**9
+	# Encoder counts truncate toward 0, the shaft is half a count further out on average.
+	y = (counts + 0.5*np.sign(counts)) * (TAU / cpr)
+	weight = valid.astype(np.float64)
+	u = (codes - 511.5) / 511.5
+	held = (settings['deadband'] is not None)
+	delays = range(settings['max_delay'] + 1)
+
+	taus = np.geomspace(*settings['tau_range'],settings['tau_points'])
+	if (settings['order'] == 2):
+		# 0 too, order 1 is the limit of order 2.
+		tau_es = np.concatenate([[0.0],np.geomspace(*settings['tau_electrical_range'],settings['tau_electrical_points'])])
+	else:
+		tau_es = np.zeros(1)
+	grid_tau, grid_tau_e = [g.ravel() for g in np.meshgrid(taus,tau_es,indexing='ij')]
+	shape = (len(taus),len(tau_es))
+	usable = grid_tau_e < grid_tau / 2
+	rows = np.arange(count)
+
+	deadband = np.full(count,settings['deadband'] if held else 2 / 512)
+	deadband_negative = deadband.copy()
+	for _ in range(1 if held else settings['iterations']):
+		regressors = _regressors(u,deadband[station],deadband_negative[station],held,onehot,settings['min_support'])
+		responses = _responses(regressors,time,np.broadcast_to(grid_tau,(n,grid_tau.size)),np.broadcast_to(grid_tau_e,(n,grid_tau.size)))
+		rss = np.full((count,len(delays),grid_tau.size),np.inf)
+		coefficients = np.zeros((count,len(delays),grid_tau.size,regressors.shape[2]))
+		for delay in delays:
+			c, r = _solve(responses,y,weight,delay,onehot)
+			coefficients[:,delay] = c
+			rss[:,delay] = np.where(usable & (c[:,:,0] > 0), r, np.inf)
+		best = np.argmin(rss.reshape(count,-1),axis=1)
+		best_delay, best_grid = np.unravel_index(best,rss.shape[1:])
+		c = coefficients[rows,best_delay,best_grid]
+		if (not held):
+			gain = np.where(c[:,0] > 0, c[:,0], 1.0)
+			deadband = np.clip(c[:,1] / gain,0,0.5)
+			reverse = (onehot @ regressors[:,:,2].any(axis=1)) > 0
+			deadband_negative = np.where(reverse, np.clip(c[:,2] / gain,0,0.5), deadband)
+	regressors = _regressors(u,deadband[station],deadband_negative[station],held,onehot,settings['min_support'])
+
+	# A grid point off the true tau costs more than a tick of delay, so every delay (and tau_e)
+	# gets its tau refined (parabola in log tau) and refit before they're compared.
+	step = np.log(taus[1] / taus[0]) if (len(taus) > 1) else 0.0
+	fits = []
+	for delay in delays:
+		curves = rss[:,delay].reshape(count,*shape)
+		for j, tau_e in enumerate(tau_es):
+			curve = curves[:,:,j]
+			i_tau = np.argmin(curve,axis=1)
+			lo = np.maximum(i_tau - 1,0)
+			hi = np.minimum(i_tau + 1,len(taus) - 1)
+			r0 = curve[rows,lo]
+			r1 = curve[rows,i_tau]
+			r2 = curve[rows,hi]
+			bend = r0 - 2*r1 + r2
+			inside = (lo < i_tau) & (hi > i_tau) & np.isfinite(bend) & (bend > 0)
+			shift = np.where(inside, 0.5*(r0 - r2) / np.where(inside, bend, 1.0), 0.0)
+			tau = taus[i_tau] * np.exp(shift * step)
+			tau_e = np.full(count,tau_e)
+			responses = _responses(regressors,time,tau[station,None],tau_e[station,None])
+			c, r = _solve(responses,y,weight,delay,onehot)
+			r = np.where(np.isfinite(r1) & (c[:,0,0] > 0), r[:,0], np.inf)
+			fits.append((tau, tau_e, c[:,0], r, np.full(count,delay)))
+	best = np.argmin(np.stack([fit[3] for fit in fits],axis=1),axis=1)
+	tau, tau_e, c, rss, best_delay = [np.stack([fit[i] for fit in fits],axis=1)[rows,best] for i in range(5)]
+	gain = c[:,0]
+	if (not held):
+		safe = np.where(gain > 0, gain, 1.0)
+		deadband = np.clip(c[:,1] / safe,0,0.5)
+		reverse = (onehot @ regressors[:,:,2].any(axis=1)) > 0
+		deadband_negative = np.where(reverse, np.clip(c[:,2] / safe,0,0.5), deadband)
+
+	ticks = np.where(valid[:,1:] & valid[:,:-1], np.diff(time,axis=1), np.nan)
+	period = np.nanmedian(np.where(ticks > 1e-4, ticks, np.nan),axis=1)
+	return {
+		'gain' : gain,
+		'tau' : tau,
+		'tau_electrical' : tau_e,
+		'deadband' : deadband,
+		'deadband_negative' : deadband_negative,
+		'delay' : best_delay * ((onehot @ period) / onehot.sum(axis=1)),
+		'rms' : np.sqrt(np.maximum(rss,0) / (onehot @ weight.sum(axis=1)))
+	}
+
+# runs: list of {'position', 'time'} (load(), ew305 data, batch_sim runs split per row).
+# control: the json line the runs were started with, or a list of them, one per run.
+# station: one label per run, runs with the same label are fit as one plant. Several targets
+# on one station pin the deadband down much better than any single run. Default a fit per run.
+# A run that has 'code' (ie from batch_sim) uses it instead of the replay.
+# Returns arrays shaped (stations,), keys in RESULTS: rad/s, s, fraction of full scale, rms in rad,
+# and 'station', the labels in the same order.
+def identify(runs,control=None,station=None,**kwargs):
+	# Setup default values.
+	buffer = {
+		'order' : 1,
+		'counts_per_rev' : 2000,			# what code.py was told, for json positions
+		'deadband' : None,					# fraction of full scale, hold instead of fitting
+		'max_delay' : 3,					# ticks
+		'tau_range' : (0.005, 0.5),			# s
+		'tau_points' : 48,
+		'tau_electrical_range' : (0.0005, 0.02),
+		'tau_electrical_points' : 8,
+		'iterations' : 3,
+		'min_support' : 10,					# reverse samples needed to fit deadband_negative
+		'chunk' : 32						# runs per vectorized pass
+	}
+	for arg in buffer:
+		buffer[arg] = kwargs.get(arg,buffer[arg])
+	if (buffer['order'] not in (1, 2)):
+		raise ValueError('order is 1 or 2.')
+
+	counts, time, valid = _pack(runs,buffer['counts_per_rev'])
+	configs = _controls(control)
+	given = [run.get('code') for run in runs]
+	if all([code is not None for code in given]):
+		codes = np.full(counts.shape,511.0)
+		for i, code in enumerate(given):
+			codes[i,:len(code)] = code
+	else:
+		codes = batch_sim.replay(counts,time,configs,valid=valid,counts_per_rev=buffer['counts_per_rev']).astype(np.float64)
+
+	if (station is None):
+		station = list(range(len(runs)))
+	labels, index = np.unique(np.asarray(station),return_inverse=True)
+
+	# Whole stations per pass, about 'chunk' runs each.
+	chunk = buffer['chunk'] if (buffer['order'] == 1) else max(1,buffer['chunk'] // buffer['tau_electrical_points'])
+	parts = []
+	group = []
+	for label in range(len(labels)):
+		group.append(label)
+		members = np.isin(index,group)
+		if (members.sum() >= chunk) or (label == len(labels) - 1):
+			parts.append(_fit_chunk(counts[members],time[members],valid[members],codes[members],np.searchsorted(group,index[members]),len(group),buffer))
+			group = []
+	fit = {name : np.concatenate([part[name] for part in parts]) for name in RESULTS}
+	fit['station'] = labels
+	return fit
+
+# batch_sim / tuner / robustness plant kwargs: one station (or run), or the median over all of them.
+def plant(fit,index=None):
+	if (index is None):
+		return {name : float(np.median(fit[name])) for name in PLANT}
+	return {name : float(fit[name][index]) for name in PLANT}
+
+
+
+
+###################################
+######### Testing Section #########
+###################################
+
+# Known plants through batch_sim, three targets per station, then the firmware itself in the sim
+# (sim/motor.py's plant) as one batch.
+# ex:	python3 sysid.py --check
+def check(stations=60,seed=305):
+	import os
+	import subprocess
+	from time import perf_counter
+	rng = np.random.default_rng(seed)
+	truth = {
+		'gain' : rng.uniform(40,80,stations),
+		'tau' : rng.uniform(0.02,0.1,stations),
+		'deadband' : rng.uniform(10 / 512,50 / 512,stations)
+	}
+	truth['deadband_negative'] = truth['deadband']
+	station = np.repeat(np.arange(stations),3)
+	control = {'target' : np.tile([5.0, 10.0, 20.0],stations), 'Kp' : 9.42e-8, 'Ki' : 1.256e-6, 'Kd' : 3.14e-11}
+	run = batch_sim.simulate(dict(control,**{name : value[station] for name, value in truth.items()}),time_limit=1.0)
+	logged = [{'position' : run['position'][i,run['valid'][i]], 'time' : run['time'][i,run['valid'][i]]} for i in range(len(station))]
+	start = perf_counter()
+	fit = identify(logged,control=control,station=station)
+	elapsed = perf_counter() - start
+	worst = {
+		'gain' : float(np.max(np.abs(fit['gain'] / truth['gain'] - 1))),
+		'tau' : float(np.max(np.abs(fit['tau'] / truth['tau'] - 1))),
+		'deadband' : float(np.max(np.abs(fit['deadband'] - truth['deadband'])) * 512)
+	}
+	print('LOG: ' + str(len(logged)) + ' runs, ' + str(stations) + ' stations in ' + ('%0.2f' % elapsed) + ' s, worst gain %0.2f%%, tau %0.2f%%, deadband %0.2f/512' %(100*worst['gain'], 100*worst['tau'], worst['deadband']))
+
+	here = os.path.dirname(os.path.abspath(__file__))
+	env = dict(os.environ, PYTHONPATH=os.path.join(here,'..','sim'), SIM_VIRTUAL_CLOCK='1')
+	batch = [{'target' : target, 'time_limit' : 1, 'Kp' : 9.42e-8, 'Ki' : 1.256e-6, 'Kd' : 3.14e-11} for target in (5, 10, 20)]
+	out = subprocess.run(['python3','code.py'],input=dumps(batch) + '\n',capture_output=True,text=True,cwd=os.path.join(here,'..','python'),env=env).stdout
+	runs = parse_lines(out.splitlines())
+	firmware = identify(runs,control=batch,station=[0]*len(runs))
+	print('LOG: firmware sim, ' + str(len(runs)) + ' runs: ' + dumps(plant(firmware)) + ', delay ' + ('%0.4f' % firmware['delay'][0]) + ' s (sim/motor.py: gain 60, tau 0.05, deadband 0.0547)')
+	ok = (worst['gain'] < 0.01) and (worst['tau'] < 0.02) and (worst['deadband'] < 0.5) and (abs(firmware['gain'][0] / 60 - 1) < 0.01) and (abs(firmware['tau'][0] / 0.05 - 1) < 0.02)
+	print('LOG: ' + ('PASS' if ok else 'FAIL'))
+	return ok
+
+
+if __name__ == '__main__':
+	import argparse
+	parser = argparse.ArgumentParser(description='Fit the motor model to logged step responses, prints a plant json line per station.')
+	parser.add_argument('paths',nargs='*',help='one station per file: transcripts, jsonencode(a.data) or csv exports')
+	parser.add_argument('--control',default='{}',help='json line the runs were started with, or the batch list, one per run')
+	parser.add_argument('--order',type=int,default=1,choices=[1,2])
+	parser.add_argument('--counts_per_rev',type=int,default=2000)
+	parser.add_argument('--deadband',type=float,default=None,help='hold the deadband, fraction of full scale')
+	parser.add_argument('--per_run',action='store_true',help='fit every run on its own')
+	parser.add_argument('--check',action='store_true',help='run the Testing Section instead')
+	args = parser.parse_args()
+
+	if args.check:
+		check()
+	else:
+		runs = []
+		station = []
+		for path in args.paths:
+			loaded = load(path)
+			runs += loaded
+			station += [path] * len(loaded)
+		control = loads(args.control)
+		if isinstance(control,list) and (len(control) != len(runs)):
+			# The same batch on every station.
+			if (len(runs) % len(control)):
+				raise ValueError(str(len(runs)) + ' runs is not a whole number of ' + str(len(control)) + ' run batches.')
+			control = control * (len(runs) // len(control))
+		fit = identify(runs,control=control,station=None if args.per_run else station,order=args.order,counts_per_rev=args.counts_per_rev,deadband=args.deadband)
+		for i, label in enumerate(fit['station']):
+			print('LOG: ' + str(label) + ': ' + dumps({name : round(float(fit[name][i]),6) for name in RESULTS}))
+			print(dumps(plant(fit,i)))
@@ -0,0 +1,260 @@
+# US Naval Academy
+# Robotics and Control TSD
+#
+# PID auto-tuner against the motor model in batch_sim.py.
+#
+# Searches Kp, Ki, Kd and bias in the units format_matlab_values() takes (MATLAB gains, bias in x/512),
+# and prints the winner as a json line for intake_matlab(), ie
+# 	{"target": 10, "time_limit": 1, "rate": 500, "bias": 24.3, "Kp": 2.1e-07, "Ki": 3.3e-06, "Kd": 1.2e-12, "controller": "PID"}
+# Gains the law doesn't use (Ki for 'P', Kd for 'P' and 'PI') are held at 0, and the line names the
+# law as the controller, so the device runs what was tuned. Bias takes the sign of the target,
+# a reverse move breaks away through the negative deadband like bias 'auto' does.
+#
+# Search:
+# 	1. coarse grid over the whole box
+# 	2. Nelder-Mead from the best few grid points, gains in log10 so one step is a ratio
+# All candidates of a round (the grid, or one step of every Nelder-Mead start) are split into chunks
+# and scored by batch_sim in a ProcessPoolExecutor. Scores are cached on (candidate, target, plant),
+# so candidates seen before, by this search or an earlier one on the same Tuner, are free.
+#
+# Cost, lower is better:
+# 	iae + w_rise * rise + w_overshoot * max(overshoot,0) + w_final * |final| + w_chatter * chatter
+# chatter (mean wiper code change per tick) keeps it off gains that only look good through
+# the quantization noise of a two point dx/dt.
+#
+# ex:
+# 	python3 tuner.py --target 10 --gain 60 --tau 0.05 --deadband 0.055
+# 	python3 tuner.py --target 10 --plant "$(python3 sysid.py station1.txt --control '{"target": 10}' | tail -1)"
+# 	tuner = Tuner(target=10, plant={'gain' : 55}); best = tuner.tune(); tuner.json_line(best)
+#
+
+from concurrent.futures import ProcessPoolExecutor
+from json import dumps
+import os
+import numpy as np
+
+import batch_sim
+
+NAMES = ('Kp', 'Ki', 'Kd', 'bias')
+LOG = (True, True, True, False)		# searched in log10
+TERMS = ('', 'I', 'D', '')				# letter the law needs for each to be searched
+BOUNDS = (
+	(1e-9, 1e-5),		# Kp
+	(1e-8, 1e-3),		# Ki
+	(1e-14, 1e-9),		# Kd
+	(0, 64)				# bias, x/512, (-64, 0) for a negative target
+)
+PLANT = ('gain', 'tau', 'deadband', 'deadband_negative', 'counts_per_rev', 'firmware_counts_per_rev')
+
+# Worker side: score a chunk of candidates with one vectorized simulate().
+def _cost_chunk(candidates,settings,weights):
+	candidates = np.asarray(candidates)
+	configs = {name : candidates[:,i] for i, name in enumerate(NAMES)}
+	run = batch_sim.simulate(configs,**settings)
+	scores = batch_sim.score(run)
+	cost = scores['iae'] + weights['rise']*scores['rise'] + weights['overshoot']*np.maximum(scores['overshoot'],0) + weights['final']*np.abs(scores['final']) + weights['chatter']*scores['chatter']
+	return np.where(np.isfinite(cost), cost, 1e6)
+
+# Nelder-Mead as a generator: yields a list of points, gets their costs back.
+# Runs until 'iterations' or the simplex spread drops under 'tolerance'.
+def nelder_mead(x0,step,iterations=60,tolerance=1e-3):
+	n = len(x0)
+	simplex = [np.array(x0,dtype=float)]
+	for i in range(n):
+		x = np.array(x0,dtype=float)
+		x[i] += step[i]
+		simplex.append(x)
+	costs = list((yield simplex))
+	for _ in range(iterations):
+		order = np.argsort(costs)
+		simplex = [simplex[i] for i in order]
+		costs = [costs[i] for i in order]
+		if (costs[-1] - costs[0] < tolerance):
+			break
+		centroid = np.mean(simplex[:-1],axis=0)
+		worst = simplex[-1]
+		reflected = centroid + (centroid - worst)
+		(c_r,) = yield [reflected]
+		if (c_r < costs[0]):
+			expanded = centroid + 2*(centroid - worst)
+			(c_e,) = yield [expanded]
+			simplex[-1], costs[-1] = (expanded, c_e) if (c_e < c_r) else (reflected, c_r)
+		elif (c_r < costs[-2]):
+			simplex[-1], costs[-1] = reflected, c_r
+		else:
+			contracted = centroid + 0.5*(worst - centroid)
+			(c_c,) = yield [contracted]
+			if (c_c < costs[-1]):
+				simplex[-1], costs[-1] = contracted, c_c
+			else:
+				# Shrink toward the best point.
+				simplex = [simplex[0]] + [simplex[0] + 0.5*(x - simplex[0]) for x in simplex[1:]]
+				costs = [costs[0]] + list((yield simplex[1:]))
+	best = int(np.argmin(costs))
+	return simplex[best], costs[best]
+
+
+class Tuner():
+	def __init__(self,**kwargs):
+		# Setup default values.
+		buffer = {
+			'target' : 10,				# rad/s
+			'time_limit' : 1.0,			# s
+			'rate' : 500,				# Hz
+			'law' : 'PID',
+			'plant' : {},				# batch_sim.simulate() plant kwargs, ie from sysid.py
+			'weights' : {'rise' : 1.0, 'overshoot' : 0.5, 'final' : 2.0, 'chatter' : 0.01},
+			'workers' : os.cpu_count(),
+			'chunk' : 256,				# candidates per worker task
+			'grid' : 5,					# points per axis in the coarse grid
+			'starts' : 4,				# Nelder-Mead starts
+			'iterations' : 60
+		}
+		for arg in buffer:
+			buffer[arg] = kwargs.get(arg,buffer[arg])
+		self.target = buffer['target']
+		self.time_limit = buffer['time_limit']
+		self.rate = buffer['rate']
+		self.law = buffer['law']
+		self.plant = dict(buffer['plant'])
+		self.weights = buffer['weights']
+		self.workers = buffer['workers']
+		self.chunk = buffer['chunk']
+		self.grid = buffer['grid']
+		self.starts = buffer['starts']
+		self.iterations = buffer['iterations']
+		# Indices of NAMES searched for this law, the rest stay 0.
+		self.search = [i for i, term in enumerate(TERMS) if (term in self.law)]
+		self.bounds = list(BOUNDS)
+		if (self.target < 0):
+			self.bounds[3] = (-BOUNDS[3][1], -BOUNDS[3][0])
+		self.cache = {}
+		self.evaluated = 0
+		self.hits = 0
+
+	def _settings(self):
+		settings = {'target' : self.target, 'time_limit' : self.time_limit, 'rate' : self.rate, 'law' : self.law}
+		settings.update(self.plant)
+		return settings
+
+	def _plant_key(self):
+		return tuple([self.plant.get(name) for name in PLANT])
+
+	# Search coordinates (one per searched name) -> all of NAMES in intake units, clamped to bounds.
+	def to_params(self,x):
+		params = [0.0] * len(NAMES)
+		for value, i in zip(x,self.search):
+			low, high = self.bounds[i]
+			value = 10**value if LOG[i] else value
+			params[i] = min(max(value,low),high)
+		return tuple(params)
+
+	def _key(self,params):
+		rounded = tuple([float('%.4g' % value) for value in params])
+		return (rounded, self.target, self.time_limit, self.rate, self.law, self._plant_key())
+
+	# Costs of a list of candidates in intake units. Only cache misses are simulated.
+	# Candidates are rounded to 4 significant digits first, that's also the cache key.
+	def evaluate(self,candidates,pool):
+		keys = [self._key(params) for params in candidates]
+		missing = {}
+		for key in keys:
+			if (key not in self.cache) and (key not in missing):
+				missing[key] = key[0]
+		self.hits += len(keys) - len(missing)
+		if missing:
+			settings = self._settings()
+			params = list(missing.values())
+			chunks = [params[i:i + self.chunk] for i in range(0,len(params),self.chunk)]
+			futures = [pool.submit(_cost_chunk,chunk,settings,self.weights) for chunk in chunks]
+			costs = np.concatenate([future.result() for future in futures])
+			for key, cost in zip(missing,costs):
+				self.cache[key] = float(cost)
+			self.evaluated += len(missing)
+		return [self.cache[key] for key in keys]
+
+	def _grid_points(self):
+		axes = []
+		for i in self.search:
+			low, high = self.bounds[i]
+			if LOG[i]:
+				axes.append(np.linspace(np.log10(low),np.log10(high),self.grid))
+			else:
+				axes.append(np.linspace(low,high,self.grid))
+		mesh = np.meshgrid(*axes,indexing='ij')
+		return np.stack([m.ravel() for m in mesh],axis=1)
+
+	# Returns the best candidate as {'Kp', 'Ki', 'Kd', 'bias', 'cost'}.
+	def tune(self):
+		with ProcessPoolExecutor(max_workers=self.workers) as pool:
+			points = self._grid_points()
+			costs = self.evaluate([self.to_params(x) for x in points],pool)
+			order = np.argsort(costs)[:self.starts]
+
+			# One Nelder-Mead per start, stepped in lockstep so each round is one fan out.
+			step = [(0.5, 0.5, 0.5, 8)[i] for i in self.search]
+			searches = [nelder_mead(points[i],step,self.iterations) for i in order]
+			pending = [search.send(None) for search in searches]
+			results = []
+			while searches:
+				flat = [self.to_params(x) for points in pending for x in points]
+				costs = self.evaluate(flat,pool)
+				still = []
+				still_pending = []
+				i = 0
+				for search, points in zip(searches,pending):
+					answer = costs[i:i + len(points)]
+					i += len(points)
+					try:
+						still_pending.append(search.send(answer))
+						still.append(search)
+					except StopIteration as done:
+						results.append(done.value)
+				searches = still
+				pending = still_pending
+
+		x, cost = min(results,key=lambda result: result[1])
+		params = self.to_params(x)
+		best = {name : value for name, value in zip(NAMES,params)}
+		best['cost'] = cost
+		return best
+
+	# Ready to send to intake_matlab().
+	def json_line(self,best):
+		return dumps({
+			'target' : self.target,
+			'time_limit' : self.time_limit,
+			'rate' : self.rate,
+			'bias' : round(best['bias'],2),
+			'Kp' : float('%.4g' % best['Kp']),
+			'Ki' : float('%.4g' % best['Ki']),
+			'Kd' : float('%.4g' % best['Kd']),
+			'controller' : self.law
+		})
+
+
+if __name__ == '__main__':
+	import argparse
+	from json import loads
+	from time import perf_counter
+	parser = argparse.ArgumentParser(description='PID auto-tuner, prints a json line for intake_matlab().')
+	parser.add_argument('--target',type=float,default=10,help='rad/s')
+	parser.add_argument('--time_limit',type=float,default=1.0,help='s')
+	parser.add_argument('--rate',type=float,default=500,help='Hz')
+	parser.add_argument('--law',default='PID',choices=['P','PI','PID'])
+	parser.add_argument('--gain',type=float,default=60.0,help='plant rad/s at full scale')
+	parser.add_argument('--tau',type=float,default=0.05,help='plant time constant, s')
+	parser.add_argument('--deadband',type=float,default=28 / 512,help='fraction of full scale')
+	parser.add_argument('--plant',default=None,help='json plant line from sysid.py, instead of the three above')
+	parser.add_argument('--workers',type=int,default=os.cpu_count())
+	args = parser.parse_args()
+
+	plant = {'gain' : args.gain, 'tau' : args.tau, 'deadband' : args.deadband}
+	if args.plant:
+		plant = loads(args.plant)
+	tuner = Tuner(target=args.target,time_limit=args.time_limit,rate=args.rate,law=args.law,workers=args.workers,plant=plant)
+	start = perf_counter()
+	best = tuner.tune()
+	elapsed = perf_counter() - start
+	print('LOG: %d candidates simulated, %d cache hits, %0.1f s, cost %0.4f' %(tuner.evaluated, tuner.hits, elapsed, best['cost']))
+	print(tuner.json_line(best))
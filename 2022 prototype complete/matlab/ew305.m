@@ -123,6 +123,8 @@ classdef ew305 < matlab.mixin.SetGet
 			pause(0.1);
 			commands = struct('target',obj.target,'Kp',obj.Kp,'Ki',obj.Ki,'Kd',obj.Kd,'time_limit',obj.runtime,'bias',obj.bias, 'rate',obj.rate);
 			obj.serial_device.writeline(jsonencode(commands));
+            % Hang out until the experiment is designed to finish.
+            %   read_serial() then reads up to the 'LOG: end' line.
             pause(obj.runtime + 1)
 			obj.read_serial();
 			% disp(obj.data);
@@ -145,7 +147,18 @@ classdef ew305 < matlab.mixin.SetGet
 			pause(0.1);
 
    			i=0;
-			while(obj.serial_device.NumBytesAvailable)
+            ended = false;
+            waiting = tic;
+			while((~ended) || obj.serial_device.NumBytesAvailable)
+                % The RP2040 stops the motor and prefills before 'LOG: end', give it time.
+                if (obj.serial_device.NumBytesAvailable==0)
+                    if (toc(waiting) > obj.runtime + 5)
+                        warning("No 'LOG: end' from the RP2040.");
+                        break;
+                    end
+                    pause(0.05);
+                    continue;
+                end
 				i = i+1;
 				obj.buffer = readline(obj.serial_device);
 
@@ -157,6 +170,8 @@ classdef ew305 < matlab.mixin.SetGet
                 %
                 if (obj.check_serial_LOG())
                      disp(obj.buffer);
+                     ended = ended || startsWith(char(obj.buffer),'LOG: end');
+                     i = i-1;
                 else
 			        try
 				        json_data = jsondecode(obj.buffer);
@@ -171,13 +186,14 @@ classdef ew305 < matlab.mixin.SetGet
                 end
 
                 % Make sure it's really 0 and stays 0.
-                if (obj.serial_device.NumBytesAvailable==0)
+                if (ended && (obj.serial_device.NumBytesAvailable==0))
                     pause(0.1);
                 end
 
 			end % end while
             fprintf("data samples: %d\n", length(obj.data));
-            obj.reset_rp2040();
+            % The RP2040 re-arms itself between experiments (Quanser_305.rearm()),
+            %   reset_rp2040() is only needed to recover from a crash.
 		end % end function        
 
 
@@ -5,16 +5,31 @@ import busio
 import rotaryio
 from digitalio import DigitalInOut, Direction
 from ad5293 import AD5293_309
+from ringbuffer import Ring_Buffer
+import telemetry
+import controllers
+from estimators import LSQ_Velocity, AB_Observer, Edge_Velocity
+from calibration import Calibration_Store
+from feedforward import Feedforward_Map
 import ticker
 import atexit
 from json import dumps
+from array import array
 
 
 class Quanser_305():
-	def __init__(self,counts_per_revolution,sample_size):
+	# clock: time source with monotonic_ns(), sleep(seconds) and wait_until(ns), ie sim/vclock.py.
+	# None for the real time module.
+	def __init__(self,counts_per_revolution,sample_size,clock=None):
+		self.clock = clock
+		if clock:
+			self.monotonic_ns = clock.monotonic_ns
+			self.sleep = clock.sleep
+		else:
+			self.monotonic_ns = monotonic_ns
+			self.sleep = sleep
 		self.array_size = sample_size
-		self.encoder_pos = self.__form_array()
-		self.encoder_time = self.__form_array()
+		self.samples = self.__form_array()
 
 		self.tickers = self.__setup_interrupt()
 
@@ -30,6 +45,8 @@ class Quanser_305():
 				pass
 				# print("LOG: Encoder setup failed on 2nd attempt.")
 		self.__sample_offset = -2
+		# Raw encoder count that reads as 0, see zero_encoder().
+		self.encoder_zero = 0
 
 		self.encoder_counts_per_rev = counts_per_revolution
 
@@ -59,19 +76,43 @@ class Quanser_305():
 		self.target_speed = self.rad_to_counts(10)
 		self.time_limit = 1
 		self.motor_bias = 0
+		self.final_error = None		# Set by attach_controller() for registry controllers.
+		self.motor_bias_negative = 0
+		self.bias_settle = 0.05		# seconds per find_bias() probe
+		self.bias_motion = 2		# counts that count as moving
+
+		# Speed -> wiper code map from characterize(), see feedforward.py.
+		self.feedforward = None
+		self.ff_dwell = 0.01		# seconds per code in characterize()
+
+		# Cached calibration from a previous find_bias(), see calibration.py.
+		self.calibration = Calibration_Store()
+		self.calibrated = self.load_calibration()
+		self.velocity_estimator = None	# See set_velocity_window(), set_observer(), set_edge_velocity()
+		self.pulses = 0
+
+		# 'json' (one line per sample), 'binary' (one telemetry frame per run),
+		# or 'stream' (telemetry frames sent during the run, see __stream_loop).
+		self.output_format = 'json'
+		self.run_index = None		# Set during a batch, tags json samples with "run".
+		self.stream_interval = 0.01		# seconds between stream ticker slots
+		self.stream_chunk = 64			# max samples per frame, bounds time spent in one slot
+		self._streamed = 0
+		self._stream_dropped = 0
 
 	def __form_array(self):
-		buffer = []
+		buffer = 0
 		try:
-			for _ in range(self.array_size):
-				buffer.append(0)
+			buffer = Ring_Buffer(self.array_size)
 		except:
 			pass
 			# print("LOG: Memory Alloc failed. Device needs to be restarted.")
 		return buffer
 
 	def __setup_interrupt(self):
-		return ticker.Interrupt_Controller()
+		if self.clock:
+			return ticker.Interrupt_Controller(scheduler='deadline',timing='fixed',catch_up='skip',clock=self.clock.monotonic_ns,idle=self.clock.wait_until)
+		return ticker.Interrupt_Controller(scheduler='deadline',timing='fixed',catch_up='skip')
 
 	def __setup_encoder(self):
 		try:
@@ -84,12 +125,19 @@ class Quanser_305():
 		if (self.enc):
 			# print("LOG: Disabling encoder.")
 			self.enc.deinit()
+	# Hardware reset, deinit and re-create the IncrementalEncoder. ~0.5s.
+	# Runs use zero_encoder() instead.
 	def reset_encoder(self):
 		# print("LOG: Resetting encoder.")
 		self.__disable_encoder()
 		self.digipot.set_pot(0)
-		sleep(0.5)
+		self.sleep(0.5)
 		self.enc = self.__setup_encoder()
+		self.encoder_zero = 0
+
+	# Zero the encoder in software, the hardware count keeps going.
+	def zero_encoder(self):
+		self.encoder_zero = self.enc.position
 
 	def __setup_digipot(self):
 		# try:
@@ -110,11 +158,11 @@ class Quanser_305():
 	def reset_digipot(self):
 		try:
 			self.digipot.set_pot(0)
-			sleep(0.5)
+			self.sleep(0.5)
 			self.__disable_digipot()
 		except:
 			print("LOG: Failed to reset digipot.")
-		sleep(0.5)
+		self.sleep(0.5)
 		self.digipot = self.__setup_digipot()
 
 
@@ -153,7 +201,112 @@ class Quanser_305():
 		self.last_error = error
 
 
+	###################################
+	# Bias finder.
+	# Breakaway wiper code found by bracketing then bisecting, in each direction.
+	# Each probe starts from rest, holds one code for bias_settle seconds, and counts as
+	# moving if the encoder moved bias_motion counts. ~15 probes a side instead of
+	# one code every 0.1s up the sawtooth.
+	###################################
+
+	# True if the encoder moves at least bias_motion counts within 'settle' seconds.
+	def __moved(self,settle):
+		start = self.enc.position
+		self.sleep(settle)
+		return abs(self.enc.position - start) >= self.bias_motion
+
+	# Stop the motor and wait until the encoder holds still, or 1s. False if it never did.
+	def __wait_stopped(self):
+		self.digipot.set_raw(511)
+		for _ in range(int(1 / self.bias_settle) + 1):
+			start = self.enc.position
+			self.sleep(self.bias_settle)
+			if (self.enc.position == start):
+				return True
+		return False
+
+	# Motor off and at rest, for back to back runs.
+	def stop(self):
+		self.__wait_stopped()
+		self.digipot.set_pot(0)
+
+	# Does wiper code 511 + direction*offset get the motor going from rest?
+	def __probe(self,direction,offset):
+		self.__wait_stopped()
+		self.digipot.set_raw(min(max(511 + direction*offset,0),1023))
+		moved = self.__moved(self.bias_settle)
+		self.digipot.set_raw(511)
+		return moved
+
+	# Smallest offset from 511, in wiper codes, that starts the motor in 'direction' (+1 / -1).
+	def __breakaway(self,direction):
+		low = 0
+		high = 8
+		while (not self.__probe(direction,high)):
+			low = high
+			if (high >= 512):
+				# Never moved. Don't bias at all.
+				return 0
+			high = min(high*2,512)
+		while (high - low > 1):
+			middle = (low + high) // 2
+			if self.__probe(direction,middle):
+				high = middle
+			else:
+				low = middle
+		return high
+
+	# Returns (positive, negative) bias in set_pot() units, ie (0.055, -0.053).
+	# The result is saved to the calibration cache.
 	def find_bias(self):
+		positive = self.__breakaway(1) / 512
+		negative = -self.__breakaway(-1) / 512
+		self.__wait_stopped()
+		self.digipot.set_pot(0)
+		self.motor_bias = positive
+		self.motor_bias_negative = negative
+		self.save_calibration()
+		return positive, negative
+
+	# find_bias() only if there's no cached calibration, or force is set.
+	def calibrate(self,force=False):
+		if (force) or (not self.calibrated):
+			self.find_bias()
+		return self.motor_bias, self.motor_bias_negative
+
+	def load_calibration(self):
+		return self.apply_calibration(self.calibration.load())
+
+	# Only what find_bias() and characterize() measured. Counts per rev is whatever the
+	# constructor was given, an entry saved under another one (older firmware) doesn't change it.
+	def apply_calibration(self,entry):
+		if (not entry):
+			return False
+		self.motor_bias = entry.get('motor_bias',self.motor_bias)
+		self.motor_bias_negative = entry.get('motor_bias_negative',self.motor_bias_negative)
+		if ('feedforward' in entry):
+			self.feedforward = Feedforward_Map.from_dict(entry['feedforward'])
+		return True
+
+	def save_calibration(self):
+		self.calibrated = True
+		entry = {
+			'motor_bias' : self.motor_bias,
+			'motor_bias_negative' : self.motor_bias_negative
+		}
+		if self.feedforward:
+			entry['feedforward'] = self.feedforward.to_dict()
+		return self.calibration.save(entry)
+
+	def invalidate_calibration(self):
+		self.calibrated = False
+		self.motor_bias = 0
+		self.motor_bias_negative = 0
+		self.feedforward = None
+		return self.calibration.invalidate()
+
+	# Original linear sawtooth bias finder.
+	def find_bias_sawtooth(self):
 		# print('LOG: auto finding bias')
 		self.motor_bias = 0
 		self.speed = 0
@@ -163,7 +316,57 @@ class Quanser_305():
 		# print('LOG: found bias: ' + str(self.motor_bias))
 		# print(self.tickers.tickers)
 		self.motor_bias = self.speed/512
-		sleep(0.5)
+		self.sleep(0.5)
+
+	###################################
+	# Feedforward characterization.
+	# The sawtooth runs one full cycle, 0 up to 1023 down to 0 and back to 511, holding
+	# each code for ff_dwell seconds. The speed over each hold is credited to that code.
+	# Every code is held twice, once on the way up and once on the way down. The motor lags
+	# behind the ramp in opposite directions on the two passes, so the average of the two
+	# cancels most of that lag without waiting for steady state at each code.
+	# 2048 holds, ~20s at the default ff_dwell.
+	###################################
+
+	def __control_loop_characterize(self):
+		position = self.enc.position
+		now = self.monotonic_ns()
+		if self._ff_ticks:
+			code = self.digipot.last_code
+			self._ff_sum[code] += (position - self._ff_position) * 10**9 / (now - self._ff_time)
+			self._ff_n[code] += 1
+		self._ff_position = position
+		self._ff_time = now
+		self._ff_ticks += 1
+		if (self._ff_ticks > 2048):
+			self.digipot.set_pot(0)
+			self.tickers.pause()
+			return
+		self.__control_loop_sawtooth()
+
+	# Sweep every wiper code, build the feedforward map and save it with the calibration.
+	def characterize(self):
+		self._ff_sum = array('f',(0 for _ in range(1024)))
+		self._ff_n = array('H',(0 for _ in range(1024)))
+		self._ff_ticks = 0
+		self.speed = 0
+		self.step = 1
+		self.tickers.remove_interrupt_all()
+		self.tickers.interrupt(name='characterize',delay=self.ff_dwell,function=self.__control_loop_characterize)
+		self.tickers.loop()
+		self.tickers.remove_interrupt('characterize')
+		speeds = [(self._ff_sum[code] / self._ff_n[code]) if self._ff_n[code] else 0 for code in range(1024)]
+		self._ff_sum = 0
+		self._ff_n = 0
+		self.feedforward = Feedforward_Map(speeds)
+		self.save_calibration()
+		return self.feedforward
+
+	# Feedforward in set_pot() units for target_speed (counts/ns), 0 without a map.
+	def ff(self,target_speed):
+		if self.feedforward:
+			return self.feedforward.ff(target_speed)
+		return 0
 
 	def auto_control(self):
 		self.target_speed = self.rad_to_counts(10)
@@ -178,54 +381,214 @@ class Quanser_305():
 		self.print_results_json()
 		self.print_results_terminal()
 
-	def attach_controller(self,func_name,update_interval,timeout):
+	# func_name is either a function, called as is every update_interval,
+	# or a name from controllers.registry ('P', 'PI', 'PID', 'fixed_PID', ...).
+	# For a name, kwargs (pid, target, bias, sample_offset) are passed to controllers.build().
+	def attach_controller(self,func_name,update_interval,timeout,**kwargs):
+		self.final_error = None
+		# check_quit_loop() leaves quit set at the end of a run.
+		self.quit = 0
+		if isinstance(func_name,str):
+			func_name, self.final_error = controllers.build(func_name,self,**kwargs)
 		self.time_limit = timeout
 		self.tickers.remove_interrupt_all()
 		self.tickers.interrupt(name='check_quit', delay=self.time_limit,function=self.check_quit_loop)
 		self.tickers.interrupt(name='pid_internal',delay=update_interval,function = func_name)
 
+	# Need at least sample_offset+1 samples before get_dx() / get_dt() are valid.
+	def __prefill_count(self):
+		return max(3,-self.__sample_offset)
+
 	def __prefill_arrays(self):
-		for _ in range(3):
+		self.samples.reset()
+		if self.velocity_estimator:
+			self.velocity_estimator.reset()
+		for _ in range(self.__prefill_count()):
 			self.encoder_loop()
 
+	# Ready for the next run in place, no resets or sleeps.
+	# Everything a run leaves behind is either cleared here or rebuilt per run:
+	# 	motor			stopped, and at rest before the encoder is zeroed (the last run may still be coasting)
+	# 	encoder			zeroed in software
+	# 	samples			reset, then prefilled from the zeroed encoder
+	# 	estimator		reset()
+	# 	quit flag		cleared
+	# 	controller		registry controllers are new closures from attach_controller(),
+	# 					example controllers in code.py are reset by runit()
+	# 	ticker			deadlines restart from now when loop() starts
+	# Then checks what it can see: motor at rest, quit clear, only the prefill in the buffer, and
+	# the prefill reading the zeroed encoder (1 count of edge jitter allowed).
+	# Anything off is a LOG: Error line. Returns True if it's clean.
+	def rearm(self):
+		stopped = self.__wait_stopped()
+		self.zero_encoder()
+		self.quit = 0
+		self.__prefill_arrays()
+		problems = []
+		if (not stopped):
+			problems.append('motor still moving after 1s')
+		if self.quit:
+			problems.append('quit set')
+		prefill = self.__prefill_count()
+		if (self.samples.count != prefill) or (self.samples.written != prefill):
+			problems.append(str(self.samples.count) + ' samples, not the ' + str(prefill) + ' prefilled')
+		if (abs(self.samples.position[0]) > 1):
+			problems.append('encoder at ' + str(self.samples.position[0]) + ' after zeroing')
+		for problem in problems:
+			print('LOG: Error: rearm: ' + problem)
+		return not problems
+
 	def change_sample_offset(self,offset):
 		self.__sample_offset = -1 * (offset + 1)
 
 	def run_controller(self):
 		quit_function_exists = self.tickers.tickers.get('check_quit')
-		if (quit_function_exists[0] <= 10):
-			self.reset_encoder()
+		streaming = (self.output_format == 'stream')
+		# Streaming isn't limited by the sample buffer, so it isn't limited to 10s.
+		if (quit_function_exists[0] <= 10) or (streaming):
+			self.rearm()
 			# print('LOG: Starting external controller')
-			self.__prefill_arrays()
+			if streaming:
+				# The prefill is streamed too, it's already in the buffer. One sample per tick after it.
+				self.__marker('begin',expected=self.samples.count + int(self.time_limit / self.tickers.tickers['pid_internal'][0] + 0.5))
+				self.__start_stream()
 			self.tickers.loop()
-			self.print_results_json()
+			if streaming:
+				self.__stop_stream()
+				self.__marker('end',samples=self._streamed,dropped=self._stream_dropped)
+			else:
+				self.__marker('begin',samples=self.samples.count)
+				self.print_results()
+				self.__marker('end',samples=self.samples.count)
 		else:
 			print('LOG: Error. Cannot run external controller without all interrupts attached, or for longer than 10s.')
 			print('LOG: ' + str(self.tickers.tickers))
+			# Still framed, so the host gets an empty run instead of waiting for one.
+			self.__marker('begin',samples=0)
+			self.__marker('end',samples=0)
+
+	# Framing for host/ew305.py, as LOG lines so ew305.m still skips them:
+	# 	LOG: begin {"format" : "json", "samples" : 500}		before the data, samples to expect
+	# 	LOG: end {"format" : "json", "samples" : 500}		after the data, the run is complete
+	# Streams don't know their length up front, begin has "expected" instead and end has the real count.
+	# Both carry "run" during a batch.
+	def __marker(self,name,**fields):
+		fields['format'] = self.output_format
+		if (self.run_index is not None):
+			fields['run'] = self.run_index
+		print('LOG: ' + name + ' ' + dumps(fields))
+
+	###################################
+	# Double buffered streaming.
+	# The sample buffer is split in two halves. encoder_loop() fills one half while
+	# __stream_loop() sends the other one, stream_chunk samples per frame, from the
+	# lowest priority ticker. A half is only sent once it is full.
+	# If the writer laps the reader, the oldest unsent samples are dropped and counted.
+	###################################
+
+	def __start_stream(self):
+		self._streamed = 0
+		self._stream_dropped = 0
+		# Added last, so it loses every tie with the controller and check_quit.
+		self.tickers.interrupt(name='stream', delay=self.stream_interval, function=self.__stream_loop)
+
+	def __stream_send(self,count):
+		frame = telemetry.encode_frame(self.samples, self.encoder_counts_per_rev, self._streamed % self.samples.size, count)
+		print(telemetry.frame_to_line(frame))
+		self._streamed += count
+
+	def __stream_loop(self):
+		size = self.samples.size
+		half = size // 2
+		written = self.samples.written
+		if (written - self._streamed > size):
+			# Unsent samples got overwritten. Skip to the first half boundary still intact.
+			skip_to = ((written - size + half - 1) // half) * half
+			self._stream_dropped += skip_to - self._streamed
+			self._streamed = skip_to
+		ready = (written - written % half) - self._streamed
+		if (ready > 0):
+			self.__stream_send(min(ready, self.stream_chunk))
+
+	def __stop_stream(self):
+		self.tickers.remove_interrupt('stream')
+		# Run is over, send whatever is left including the partial half.
+		written = self.samples.written
+		if (written - self._streamed > self.samples.size):
+			self._stream_dropped += written - self.samples.size - self._streamed
+			self._streamed = written - self.samples.size
+		while (self._streamed < written):
+			self.__stream_send(min(written - self._streamed, self.stream_chunk))
+		if self._stream_dropped:
+			print('LOG: stream dropped ' + str(self._stream_dropped) + ' samples.')
+
+	def print_results(self):
+		if (self.output_format == 'binary'):
+			self.print_results_binary()
+		else:
+			self.print_results_json()
+
+	def print_results_binary(self):
+		frame = telemetry.encode_frame(self.samples, self.encoder_counts_per_rev, self.samples.oldest(), self.samples.count)
+		print(telemetry.frame_to_line(frame))
 
 	def print_results_json(self):
 		json_data = {}
-		first_entry = 0
-		for i in range(len(self.encoder_pos)):
-			if (self.encoder_pos[i] or self.encoder_time[i]):
-				if (not first_entry):
-					first_entry = i
-				json_data['position'] = self.encoder_pos[i] * self.tau / self.encoder_counts_per_rev
-				json_data['time'] = (self.encoder_time[i] - self.encoder_time[first_entry]) / 10**9
-				print(dumps(json_data))
-		# print("LOG: len " + str(len(self.encoder_pos) - first_entry))
+		first_time = self.samples.time[self.samples.oldest()]
+		if (self.run_index is not None):
+			json_data['run'] = self.run_index
+		for position, time in self.samples.ordered():
+			json_data['position'] = position * self.tau / self.encoder_counts_per_rev
+			json_data['time'] = (time - first_time) / 10**9
+			print(dumps(json_data))
+		# print("LOG: len " + str(self.samples.count))
 
 	def encoder_loop(self):
-		self.encoder_pos.pop(0)
-		self.encoder_time.pop(0)
-		self.encoder_pos.append(self.enc.position)
-		self.encoder_time.append(monotonic_ns())
+		position = self.enc.position - self.encoder_zero
+		now = self.monotonic_ns()
+		self.samples.append(position, now)
+		if self.velocity_estimator:
+			self.velocity_estimator.update(position, now)
+
+	# Least squares speed over the last 'window' samples, see estimators.py.
+	# 0 turns it off and get_velocity() falls back to get_dx() / get_dt().
+	def set_velocity_window(self,window):
+		if window:
+			self.velocity_estimator = LSQ_Velocity(window)
+		else:
+			self.velocity_estimator = None
+
+	# Alpha-beta-gamma observer fed by encoder_loop(), see estimators.py.
+	# Takes the place of the least squares window. kwargs as AB_Observer:
+	# 	theta, dt (nominal tick), and optionally a motor model gain (counts/s), tau, deadband.
+	def set_observer(self,**kwargs):
+		kwargs['digipot'] = self.digipot
+		self.velocity_estimator = AB_Observer(**kwargs)
+
+	# Period mode speed at low speed, count mode at high speed, see estimators.Edge_Velocity.
+	# Edge times come from a PulseIn on one encoder channel, wired to GP16 (see dev/code_pulse.py),
+	# since rotaryio already holds GP14 / GP15. Pass pulses= to use another edge source.
+	# Other kwargs go to Edge_Velocity (counts_per_edge, count_above, period_below).
+	def set_edge_velocity(self,**kwargs):
+		pulses = kwargs.pop('pulses',None)
+		if (not pulses):
+			if (not self.pulses):
+				import pulseio
+				self.pulses = pulseio.PulseIn(board.GP16,maxlen=64)
+			pulses = self.pulses
+		self.velocity_estimator = Edge_Velocity(pulses,**kwargs)
+
+	# counts per ns
+	def get_velocity(self):
+		if self.velocity_estimator:
+			return self.velocity_estimator.velocity()
+		return self.get_dx() / self.get_dt()
 
 	def get_dx(self):
-		return self.encoder_pos[-1] - self.encoder_pos[self.__sample_offset]
+		return self.samples.dx(self.__sample_offset)
 
 	def get_dt(self):
-		return self.encoder_time[-1] - self.encoder_time[self.__sample_offset]
+		return self.samples.dt(self.__sample_offset)
 
 	def rad_to_counts(self,radians):
 		return radians * (self.encoder_counts_per_rev / self.tau)
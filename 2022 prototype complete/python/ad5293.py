@@ -37,6 +37,8 @@ class AD5293_309():
 		self._minn = 0x000
 		self._maxn = 0x3ff
 		self.lookup_table = {}
+		self._frames = self._build_frames()
+		self.last_code = 511		# Last wiper code sent through set_pot() / set_raw().
 
 		self._ready = False
 		attempts = 0
@@ -63,6 +65,17 @@ class AD5293_309():
 		self._write([0x1b,0xff])
 		self._write([0x06,0x02])
 
+	# Every wiper code's SPI frame, built once. 1024 codes * 2 bytes = 2 KB.
+	# Code n lives at self._frames[2n:2n+2].
+	# See data sheet page 19: command 0x04 (write RDAC) in the top of the MSB.
+	def _build_frames(self):
+		update_command = 0x04
+		frames = bytearray(2 * (self._maxn + 1))
+		for val in range(self._maxn + 1):
+			frames[2*val] = ((val & 0xff00) >> 8) | update_command
+			frames[2*val + 1] = val & 0xff
+		return frames
+
 	# def populate_lookup(self):
 	# 	resolution = 2000
 	# 	for i in range(resolution+1):
@@ -109,36 +122,68 @@ class AD5293_309():
 		# return int((511.5 * n)+0.5) + 511					# 0.9199 s / 2048 cycles
 		# return round((511.5 * n)+0.5) + 511				# 0.9971 s / 2048 cycles
 
-	# val shall be [0,1027]
+	# Send the precomputed frame for wiper code val.
+	# write(start=,end=) sends a slice of the table without allocating.
+	# A memoryview slice would allocate a new memoryview object every call on CircuitPython.
+	def _write_code(self,val):
+		self.last_code = val
+		if self._ready:
+			self._cs.value = 0
+			self._bus.write(self._frames,start=2*val,end=2*val+2)
+			self._cs.value = 1
+		else:
+			print("LOG: Error: AD5293 not ready, wiper code "+str(val)+" not sent.")
+
+	# val shall be [0,1023]
 	def set_raw(self,val):
-		update_command = 0x04
-		data_LSB = val & 0xff
-		data_MSB = ((val & 0xff00) >> 8) | update_command
-		self._write([data_MSB,data_LSB])
+		if (val < self._minn):
+			val = self._minn
+		elif (val > self._maxn):
+			val = self._maxn
+		self._write_code(val)
 
 	# val shall be [-1,1]
 	def set_pot(self,val):
-		# Check that SPI bus is available.
-		# if self._ready:
-
-		# See data sheet page 19
+		# Same as _transform(), with the clamp inlined.
+		val = int((511.5 * val)+0.5) + 511
+		if (val < 0):
+			val = 0
+		elif (val > 1023):
+			val = 1023
+		self._write_code(val)
+
+	# Original set_pot(). Kept to benchmark against.
+	def _set_pot_list(self,val):
 		update_command = 0x04
-		# print(val)
 		val = self._transform(val)
-		# print('digipot: '+str(val))
-
-		# Break val into 2 sets of 8bit.
-		# See data sheet page 19.
 		data_LSB = val & 0xff
 		data_MSB = ((val & 0xff00) >> 8) | update_command
-
-		# Send it.
 		self._write([data_MSB,data_LSB])
 
-		# 	if (not success):
-		# 		print('AD5293.set_pot() failed to write to device.')
-		# else:
-		# 	print("AD5293.set_pot() failed. SPI bus not available.")
+
+
+
+###################################
+######### Testing Section #########
+###################################
+
+# 2048 writes sweeping [-1,1], old set_pot() vs the frame table.
+# The old path measured ~1.0166 s / 2048 cycles on the RP2040 (see _transform()).
+# ex:
+# 	import ad5293
+# 	ad5293.benchmark(quanser_305.digipot)
+def benchmark(digipot,cycles=2048):
+	sweep = [(2 * i / (cycles - 1)) - 1 for i in range(cycles)]
+	results = {}
+	for name, func in (('list',digipot._set_pot_list),('table',digipot.set_pot)):
+		start = monotonic_ns()
+		for val in sweep:
+			func(val)
+		end = monotonic_ns()
+		results[name] = (end - start) / 10**9
+		print('LOG: ' + name + ': ' + str(results[name]) + ' s / ' + str(cycles) + ' cycles')
+	digipot.set_pot(0)
+	return results
 
 
 
@@ -0,0 +1,75 @@
+# US Naval Academy
+# Robotics and Control TSD
+#
+# Calibration cache, so startup doesn't have to find the bias again.
+#
+# Stored in CIRCUITPY flash as calibration.json, one entry per board:
+# 	{"raspberry_pi_pico:e6614103e7...": {"motor_bias": 0.055, "motor_bias_negative": -0.051}}
+# Only measured values, counts per rev comes from code.py.
+# Keyed by board.board_id plus the RP2040's unique id, since every Pico has the same board_id.
+#
+# CIRCUITPY is read-only to code.py unless boot.py remounts it:
+# 	import storage
+# 	storage.remount('/', readonly=False)
+# (the host can't write to the drive while that's in effect.)
+# If the write fails, the entry is printed as a 'CAL:' json line instead, for the host side
+# cache in host/calibration_cache.py to keep. The host sends it back at connect with
+# {"command": "load_calibration", "calibration": {...}}.
+#
+
+from json import loads, dumps
+
+def board_key():
+	try:
+		import board
+		board_id = board.board_id
+	except (ImportError, AttributeError):
+		board_id = 'unknown'
+	try:
+		import microcontroller
+		uid = ''.join(['%02x' % b for b in microcontroller.cpu.uid])
+	except (ImportError, AttributeError):
+		uid = ''
+	return board_id + ':' + uid
+
+
+class Calibration_Store():
+	def __init__(self,path='calibration.json',key=None):
+		self.path = path
+		self.key = key or board_key()
+
+	def _read_all(self):
+		try:
+			with open(self.path,'r') as f:
+				return loads(f.read())
+		except (OSError, ValueError):
+			return {}
+
+	def _write_all(self,data):
+		try:
+			with open(self.path,'w') as f:
+				f.write(dumps(data))
+			return True
+		except OSError:
+			return False
+
+	# This board's entry, or {} if there isn't one.
+	def load(self):
+		return self._read_all().get(self.key,{})
+
+	def save(self,entry):
+		data = self._read_all()
+		data[self.key] = entry
+		if (not self._write_all(data)):
+			print('CAL: ' + dumps({'key' : self.key, 'calibration' : entry}))
+			return False
+		return True
+
+	def invalidate(self):
+		data = self._read_all()
+		if (self.key in data):
+			data.pop(self.key)
+			if (not self._write_all(data)):
+				print('CAL: ' + dumps({'key' : self.key, 'calibration' : None}))
+				return False
+		return True
@@ -5,19 +5,28 @@
 #
 
 from Quanser_305 import Quanser_305
-from time import sleep
+import controllers
 import atexit
-from json import loads
+from json import loads, dumps
 import supervisor
 import sys
-from tictoc import tictoc
+from tictoc import tictoc, set_clock
 from math import pi
 tau = 2*pi
 
 encoder_counts_per_rev = 2000
 max_samples = 1000
 
-quanser_305 = Quanser_305(encoder_counts_per_rev, max_samples)
+# Time source, None for real time.
+# Only the sim has a vclock module, its clock is virtual when SIM_VIRTUAL_CLOCK is set (see sim/vclock.py).
+try:
+	from vclock import active as clock
+except ImportError:
+	clock = None
+if clock:
+	set_clock(clock.monotonic_ns)
+
+quanser_305 = Quanser_305(encoder_counts_per_rev, max_samples, clock)
 
 
 
@@ -70,7 +79,10 @@ def control_loop_PID():
 ###################################
 ###################################
 
-controller_func_name = control_loop_PID
+# Either a name from controllers.registry ('P', 'PI', 'PID', 'fixed_P', 'fixed_PI', 'fixed_PID'),
+# built with everything captured as locals (see controllers.py),
+# or one of the example functions above, ie control_loop_PID.
+controller_func_name = 'PID'
 time_limit = 1
 controller_rate = 0.00005
 target_speed = (10 / tau) * encoder_counts_per_rev / 10**9		# 10 rad/s
@@ -79,6 +91,10 @@ sample_offset = 2	# Change how many samples away to get dx and dt.
 					# ie,	last sample is 100th pair of position and time.
 					# 		If set to 1, compares that to the 99th entry.
 					#		To compare against 98th entry, set this to 2.
+velocity_window = 0	# >0 to use a least squares speed over that many samples instead of dx/dt.
+observer = None		# AB_Observer kwargs to use the observer's speed instead, ie {'theta' : 0.8, 'dt' : 0.002}
+edge_velocity = None	# Edge_Velocity kwargs for period / count mode speed instead, ie {'count_above' : 8}
+feedforward = False		# True for bias from Quanser_305.ff(target_speed), after characterize
 pid = {
 	'Kp' : 0.00003 * 10**9,
 	'Ki' : 0.0004,
@@ -88,12 +104,38 @@ pid = {
 
 def runit():
 	# quanser_305.auto_control()
-	global controller_rate, time_limit, controller_func_name, target_speed, sample_offset
+	global controller_rate, time_limit, controller_func_name, target_speed, sample_offset, velocity_window, observer, edge_velocity, feedforward
+	global error, last_error, i_term
+	# State of the example controllers above, registry controllers start fresh on their own.
+	error = 0
+	last_error = 0
+	i_term = 0
 	quanser_305.change_sample_offset(sample_offset)
-	quanser_305.attach_controller(controller_func_name, controller_rate, time_limit)
+	quanser_305.attach_controller(controller_func_name, controller_rate, time_limit, pid=pid, target=target_speed, bias=bias, sample_offset=sample_offset, velocity_window=velocity_window, observer=observer, edge_velocity=edge_velocity, feedforward=feedforward)
 	quanser_305.run_controller()
-	print("LOG: final err: %0.2f%%" %(100 * last_error / target_speed))
-	sleep(1)
+	if quanser_305.final_error:
+		print("LOG: final err: %0.2f%%" %(100 * quanser_305.final_error()))
+	else:
+		print("LOG: final err: %0.2f%%" %(100 * last_error / target_speed))
+	# Motor off and at rest before the next line comes in.
+	quanser_305.stop()
+
+# Run a list of parameter sets back to back, ie
+# 	[{"Kp" : 9.42e-8}, {"Kp" : 1.9e-7}, {"Kp" : 3.8e-7, "Ki" : 0}]
+# Each set starts from control_data (what the last single run used), not from the set before it.
+# Each run starts with 'LOG: run {"run" : i, "of" : n}', json samples carry "run" : i.
+# Between runs the motor is stopped, the encoder zeroed and the controller re-attached.
+def run_batch(control_data,batch):
+	for run, params in enumerate(batch):
+		buffer = {}
+		for key in control_data:
+			buffer[key] = params.get(key,control_data[key])
+		format_matlab_values(buffer)
+		quanser_305.run_index = run
+		print('LOG: run ' + dumps({'run' : run, 'of' : len(batch)}))
+		runit()
+	quanser_305.run_index = None
+	print('LOG: batch complete ' + dumps({'runs' : len(batch)}))
 
 
 
@@ -104,19 +146,71 @@ def runit():
 
 def format_matlab_values(matlab_data):
 	global encoder_counts_per_rev
-	global time_limit, controller_rate, target_speed, bias, pid
+	global time_limit, controller_rate, target_speed, bias, pid, velocity_window, observer, edge_velocity, feedforward
+	global controller_func_name
 	conversion_factor = encoder_counts_per_rev / tau
 
 	target_speed = matlab_data['target'] * conversion_factor / 10**9
 	time_limit = matlab_data['time_limit']
-	controller_rate = max((1 / matlab_data['rate']) - 0.002,0.0005)
-	bias = matlab_data['bias'] / 512
+	controller_rate = max(1 / matlab_data['rate'],0.0005)
+	# 'auto' for the cached calibration from find_bias(), see calibration.py
+	# Reverse moves break away at motor_bias_negative (already negative).
+	if (matlab_data['bias'] == 'auto'):
+		if (matlab_data['target'] < 0):
+			bias = quanser_305.motor_bias_negative
+		else:
+			bias = quanser_305.motor_bias
+	else:
+		bias = matlab_data['bias'] / 512
 	pid['Kp'] = matlab_data['Kp'] * conversion_factor * 10**9
 	pid['Ki'] = matlab_data['Ki'] * conversion_factor
 	pid['Kd'] = matlab_data['Kd'] * conversion_factor * 10**18
+	quanser_305.output_format = matlab_data['format']
+	velocity_window = int(matlab_data['velocity_window'])
+	# 'observer' : {'theta' : 0.8, 'gain' : 19000, 'tau' : 0.05, 'deadband' : 0.055}, gain in counts/s
+	observer = matlab_data['observer']
+	if observer:
+		observer['dt'] = controller_rate
+	# 'edge_velocity' : {} for the defaults, or ie {'count_above' : 8, 'period_below' : 4}
+	edge_velocity = matlab_data['edge_velocity']
+	# true for bias from the characterize sweep, see feedforward.py
+	feedforward = matlab_data['feedforward']
+	# A name from controllers.registry, ie 'P' or 'PI' for a tuner.py line tuned for that law.
+	controller_func_name = matlab_data['controller']
 	# print('LOG: ' + str(pid))
 	# print('LOG: ' + str(target_speed))
 
+# Non-run commands, ie {"command" : "calibrate"}
+# 	calibrate				find_bias() if there's no cached calibration
+# 	recalibrate				find_bias() regardless
+# 	invalidate_calibration	drop the cached calibration, next calibrate runs find_bias()
+# 	characterize			sweep all wiper codes for the feedforward map
+# 	calibration				print what's cached
+# 	load_calibration		use {"calibration" : {...}} from the host cache, when CIRCUITPY is read-only
+# 							and calibration.json couldn't be saved (see host/calibration_cache.py)
+def run_command(command,message):
+	if (command == 'calibrate'):
+		quanser_305.calibrate()
+	elif (command == 'recalibrate'):
+		quanser_305.calibrate(force=True)
+	elif (command == 'characterize'):
+		quanser_305.characterize()
+		print('LOG: feedforward map up to %0.1f rad/s' %(quanser_305.feedforward.max_speed() * tau / quanser_305.encoder_counts_per_rev))
+	elif (command == 'invalidate_calibration'):
+		quanser_305.invalidate_calibration()
+	elif (command == 'load_calibration'):
+		quanser_305.calibrated = quanser_305.apply_calibration(message.get('calibration'))
+	elif (command != 'calibration'):
+		print('LOG: unknown command: ' + str(command))
+		return
+	print('LOG: ' + dumps({
+		'key' : quanser_305.calibration.key,
+		'calibrated' : quanser_305.calibrated,
+		'motor_bias' : quanser_305.motor_bias,
+		'motor_bias_negative' : quanser_305.motor_bias_negative,
+		'counts_per_rev' : quanser_305.encoder_counts_per_rev
+	}))
+
 def intake_matlab():
 	control_data = {
 		'target' : 10,
@@ -125,7 +219,13 @@ def intake_matlab():
 		'bias' : 0,
 		'Kp' : 9.42e-8, 
 		'Ki' : 1.256e-6, 
-		'Kd' : 3.14e-11
+		'Kd' : 3.14e-11,
+		'format' : 'json',
+		'velocity_window' : 0,
+		'observer' : None,
+		'edge_velocity' : None,
+		'feedforward' : False,
+		'controller' : 'PID'
 	}
 	# print("LOG: Ready for showtime. Enter parameters.")
 	while(1):
@@ -134,16 +234,37 @@ def intake_matlab():
 			buffer = sys.stdin.readline()
 			try:
 				buffer_json = loads(buffer)
-				for key in control_data:
-					control_data[key] = buffer_json.get(key,control_data[key])
-				# print('LOG: intake:'+str(control_data))
 			except:
 				print('LOG: DataType Error: input was not in correct json format.')
 				print("LOG: " + str(buffer))
+			# Outside the try, so a run that fails isn't reported as bad json.
+			# Only an object, or a list of them, is a run. ie 5 or "go" is valid json but not a run.
+			if isinstance(buffer_json,list):
+				if not all([isinstance(params,dict) for params in buffer_json]):
+					print('LOG: Error: a batch is a list of json objects.')
+					print("LOG: " + str(buffer))
+					continue
+			elif not isinstance(buffer_json,dict):
+				print('LOG: Error: input was not a json object.')
+				print("LOG: " + str(buffer))
+				continue
+			# A controller that isn't in the registry would only fail once the run started.
+			unknown = [params['controller'] for params in (buffer_json if isinstance(buffer_json,list) else [buffer_json]) if (params.get('controller','PID') not in controllers.registry)]
+			if unknown:
+				print('LOG: Error: unknown controller ' + str(unknown[0]) + ', one of ' + ', '.join(controllers.registry) + '.')
+				continue
+			if isinstance(buffer_json,list):
+				run_batch(control_data,buffer_json)
+				continue
+			if ('command' in buffer_json):
+				run_command(buffer_json['command'],buffer_json)
+				continue
+			for key in control_data:
+				control_data[key] = buffer_json.get(key,control_data[key])
+			# print('LOG: intake:'+str(control_data))
 			format_matlab_values(control_data)
 			runit()
 			# print("LOG: Lab complete. Enter new parameters in json format.")
-			sleep(0.5)
 
 
 
@@ -0,0 +1,179 @@
+# US Naval Academy
+# Robotics and Control TSD
+#
+# Controller builders.
+# Same control math as control_loop_P / PI / PID in code.py, but built as closures:
+# gains, target, bias, sample offset and the bound methods used every tick are captured
+# as locals once, instead of global and dict / attribute lookups on every tick.
+#
+# ex:
+# 	func, final_error = controllers.build('PID', quanser_305, pid=pid, target=target_speed, bias=bias, sample_offset=2)
+# 	quanser_305.attach_controller('PID', rate, timeout, pid=pid, target=target_speed, bias=bias, sample_offset=2)
+#
+# final_error() returns the last error as a fraction of the target, for runit()'s "final err".
+#
+# Speed estimators, see estimators.py. Each swaps the two point dx/dt speed for its own,
+# dt for the I and D terms doesn't change. First one set wins:
+# 	edge_velocity		dict of Quanser_305.set_edge_velocity() kwargs, period / count mode
+# 	observer			dict of AB_Observer kwargs, alpha-beta-gamma observer
+# 	velocity_window		> 0, least squares over that many samples
+# build() sets it up on the Quanser_305, builders pick it up as quanser.velocity_estimator.
+#
+# feedforward=True replaces bias with quanser.ff(target), the wiper setting the
+# characterize() sweep says holds that speed, so the integrator only has to make up the difference.
+#
+# Custom laws:
+# 	def build_mine(quanser, pid, target, bias, sample_offset):
+# 		...
+# 		return func, final_error
+# 	controllers.register('mine', build_mine)
+#
+
+from fixed_pid import Fixed_PID
+
+# Bound methods and constants every builder needs.
+# The ring buffer offset is the same one Quanser_305.get_dx() / get_dt() use.
+def _capture(quanser,sample_offset):
+	quanser.change_sample_offset(sample_offset)
+	samples = quanser.samples
+	return quanser.encoder_loop, samples.dx, samples.dt, -1 * (sample_offset + 1), quanser.digipot, quanser.velocity_estimator
+
+def build_P(quanser,pid,target,bias,sample_offset):
+	encoder_loop, get_dx, get_dt, offset, digipot, estimator = _capture(quanser,sample_offset)
+	set_pot = digipot.set_pot
+	kp = pid['Kp']
+	state = [0]		# last error
+	estimated = bool(estimator)
+	if estimated:
+		speed = estimator.velocity
+
+	def control_loop_P():
+		encoder_loop()
+		if estimated:
+			error = target - speed()
+		else:
+			error = target - (get_dx(offset) / get_dt(offset))
+		set_pot(bias + kp * error)
+		state[0] = error
+
+	def final_error():
+		return state[0] / target
+
+	return control_loop_P, final_error
+
+def build_PI(quanser,pid,target,bias,sample_offset):
+	encoder_loop, get_dx, get_dt, offset, digipot, estimator = _capture(quanser,sample_offset)
+	set_pot = digipot.set_pot
+	kp = pid['Kp']
+	ki = pid['Ki']
+	state = [0, 0]	# last error, i_term
+	estimated = bool(estimator)
+	if estimated:
+		speed = estimator.velocity
+
+	def control_loop_PI():
+		encoder_loop()
+		dt = get_dt(offset)
+		if estimated:
+			error = target - speed()
+		else:
+			error = target - (get_dx(offset) / dt)
+		i_term = state[1] + ki * error * dt
+		set_pot(bias + kp * error + i_term)
+		state[0] = error
+		state[1] = i_term
+
+	def final_error():
+		return state[0] / target
+
+	return control_loop_PI, final_error
+
+def build_PID(quanser,pid,target,bias,sample_offset):
+	encoder_loop, get_dx, get_dt, offset, digipot, estimator = _capture(quanser,sample_offset)
+	set_pot = digipot.set_pot
+	kp = pid['Kp']
+	ki = pid['Ki']
+	kd = pid['Kd']
+	state = [0, 0]	# last error, i_term
+	estimated = bool(estimator)
+	if estimated:
+		speed = estimator.velocity
+
+	def control_loop_PID():
+		encoder_loop()
+		dt = get_dt(offset)
+		if estimated:
+			error = target - speed()
+		else:
+			error = target - (get_dx(offset) / dt)
+		i_term = state[1] + ki * error * dt
+		d_term = kd * (error - state[0]) / dt
+		set_pot(bias + kp * error + i_term + d_term)
+		state[0] = error
+		state[1] = i_term
+
+	def final_error():
+		return state[0] / target
+
+	return control_loop_PID, final_error
+
+# Integer fixed point laws, see fixed_pid.py.
+def _build_fixed(law):
+	def build_fixed(quanser,pid,target,bias,sample_offset):
+		encoder_loop, get_dx, get_dt, offset, digipot, estimator = _capture(quanser,sample_offset)
+		set_raw = digipot.set_raw
+		controller = Fixed_PID(pid,target,bias,law)
+		update = controller.update
+		estimated = bool(estimator)
+		if estimated:
+			speed = estimator.counts_per_second
+
+		def control_loop_fixed():
+			encoder_loop()
+			if estimated:
+				set_raw(update(0,get_dt(offset),speed()))
+			else:
+				set_raw(update(get_dx(offset),get_dt(offset)))
+
+		def final_error():
+			return controller.last_error / controller.target
+
+		return control_loop_fixed, final_error
+	return build_fixed
+
+
+registry = {
+	'P' : build_P,
+	'PI' : build_PI,
+	'PID' : build_PID,
+	'fixed_P' : _build_fixed('P'),
+	'fixed_PI' : _build_fixed('PI'),
+	'fixed_PID' : _build_fixed('PID')
+}
+
+def register(name,builder):
+	registry[name] = builder
+
+def build(name,quanser,**kwargs):
+	# Setup default values.
+	buffer = {
+		'pid' : {'Kp' : 0, 'Ki' : 0, 'Kd' : 0},
+		'target' : 0,			# counts/ns
+		'bias' : 0,				# [-1,1]
+		'sample_offset' : 1,
+		'velocity_window' : 0,	# 0 for two point dx/dt
+		'observer' : None,		# AB_Observer kwargs
+		'edge_velocity' : None,	# Quanser_305.set_edge_velocity() kwargs
+		'feedforward' : False	# bias from Quanser_305.ff(target)
+	}
+	for arg in buffer:
+		buffer[arg] = kwargs.get(arg,buffer[arg])
+	if (buffer['edge_velocity'] is not None):
+		quanser.set_edge_velocity(**buffer['edge_velocity'])
+	elif (buffer['observer'] is not None):
+		quanser.set_observer(**buffer['observer'])
+	else:
+		quanser.set_velocity_window(buffer['velocity_window'])
+	if (buffer['feedforward']) and (quanser.feedforward):
+		buffer['bias'] = quanser.ff(buffer['target'])
+	return registry[name](quanser,buffer['pid'],buffer['target'],buffer['bias'],buffer['sample_offset'])
@@ -0,0 +1,281 @@
+# US Naval Academy
+# Robotics and Control TSD
+#
+# Speed estimators for Quanser_305, used in place of get_dx() / get_dt().
+# All of them return counts per ns, same units as dx/dt and target_speed in code.py.
+#
+
+from array import array
+
+# Least squares slope of position vs time over the last 'window' samples.
+# At high loop rates the two point dx/dt only sees a few counts per tick, so it is mostly
+# quantization noise. Fitting a line through the whole window averages that out.
+#
+# Running sums make each update O(1): add the new sample, subtract the one leaving.
+# 	slope = (n*Stx - St*Sx) / (n*Stt - St*St)
+# Sums are exact integers, with t in us and both t and x relative to an origin that is moved
+# up to the oldest sample every 'window' updates. CircuitPython floats are single precision,
+# float running sums of t**2 would cancel out.
+class LSQ_Velocity():
+	def __init__(self,window):
+		self.window = max(2,window)
+		self.position = array('l',(0 for _ in range(self.window)))
+		self.time = array('q',(0 for _ in range(self.window)))
+		self.reset()
+
+	def reset(self):
+		self.index = 0
+		self.n = 0
+		self.since_rebase = 0
+		self.t0 = 0
+		self.x0 = 0
+		self.St = 0
+		self.Sx = 0
+		self.Stt = 0
+		self.Stx = 0
+
+	# Move the origin to (t0, x0) without touching the samples.
+	def _rebase(self,t0,x0):
+		dt = t0 - self.t0
+		dx = x0 - self.x0
+		n = self.n
+		# Shift t first: sums of (t - dt)
+		self.Stt += n*dt*dt - 2*dt*self.St
+		self.Stx -= dt*self.Sx
+		self.St -= n*dt
+		# Then x: sums of (x - dx)
+		self.Stx -= dx*self.St
+		self.Sx -= n*dx
+		self.t0 = t0
+		self.x0 = x0
+
+	# position in counts, time in ns (monotonic_ns()).
+	def update(self,position,time):
+		t_us = time // 1000
+		i = self.index
+		if (self.n == self.window):
+			t = self.time[i] - self.t0
+			x = self.position[i] - self.x0
+			self.St -= t
+			self.Sx -= x
+			self.Stt -= t*t
+			self.Stx -= t*x
+		else:
+			if (not self.n):
+				self.t0 = t_us
+				self.x0 = position
+			self.n += 1
+		self.position[i] = position
+		self.time[i] = t_us
+		t = t_us - self.t0
+		x = position - self.x0
+		self.St += t
+		self.Sx += x
+		self.Stt += t*t
+		self.Stx += t*x
+		i += 1
+		if (i == self.window):
+			i = 0
+		self.index = i
+
+		self.since_rebase += 1
+		if (self.since_rebase >= self.window):
+			self.since_rebase = 0
+			# Oldest sample is the next one to be overwritten.
+			oldest = i if (self.n == self.window) else 0
+			self._rebase(self.time[oldest],self.position[oldest])
+
+	# Integer counts per second, for Fixed_PID.update().
+	def counts_per_second(self):
+		n = self.n
+		den = n*self.Stt - self.St*self.St
+		if (not den):
+			return 0
+		return ((n*self.Stx - self.St*self.Sx) * 1000000) // den
+
+	# counts per ns
+	def velocity(self):
+		n = self.n
+		den = n*self.Stt - self.St*self.St
+		if (not den):
+			return 0
+		return (n*self.Stx - self.St*self.Sx) / (den * 1000)
+
+
+# Alpha-beta-gamma state observer: position, velocity and a disturbance (bias) term.
+#
+# 	predict		x = x + v*h
+# 				v = v + (a_model + d)*h
+# 	correct		r = counts - x
+# 				x += g*r		v += (h_gain/T)*r		d += (2*k_gain/T**2)*r
+#
+# Gains are the fading memory ones for a memory factor theta in (0,1), precomputed once for the
+# nominal tick T. Smaller theta reacts faster, larger theta filters more.
+# 	g = 1 - theta**3		h = 1.5*(1 - theta)**2*(1 + theta)		k = 0.5*(1 - theta)**3
+#
+# With a motor model (gain > 0), a_model comes from the last wiper code sent by the digipot:
+# 	a_model = (gain*(u - sign(u)*deadband) - v) / tau		u = (code - 511.5) / 511.5
+# and d only has to pick up what the model gets wrong. Without one, d tracks the whole acceleration.
+# x in counts, v in counts/s, d in counts/s**2.
+class AB_Observer():
+	def __init__(self,**kwargs):
+		# Setup default values.
+		buffer = {
+			'theta' : 0.8,			# memory factor
+			'dt' : 0.002,			# nominal tick, seconds
+			'gain' : 0,				# counts/s at full scale, 0 for no motor model
+			'tau' : 0.05,			# seconds
+			'deadband' : 0,			# fraction of full scale
+			'digipot' : None		# AD5293_309, for the commanded wiper code
+		}
+		for arg in buffer:
+			buffer[arg] = kwargs.get(arg,buffer[arg])
+		theta = buffer['theta']
+		T = buffer['dt']
+		self.g = 1 - theta**3
+		self.h = 1.5 * (1 - theta)**2 * (1 + theta) / T
+		self.k = 2 * 0.5 * (1 - theta)**3 / (T * T)
+		self.gain = buffer['gain']
+		self.inv_tau = 1 / buffer['tau']
+		self.deadband = buffer['deadband']
+		self.digipot = buffer['digipot']
+		self.reset()
+
+	def reset(self):
+		self.started = False
+		self.last_time = 0
+		self.position = 0.0
+		self.speed = 0.0
+		self.disturbance = 0.0
+
+	def _model(self):
+		if (not self.gain) or (not self.digipot):
+			return 0.0
+		u = (self.digipot.last_code - 511.5) / 511.5
+		if (u > self.deadband):
+			w_ss = self.gain * (u - self.deadband)
+		elif (u < -self.deadband):
+			w_ss = self.gain * (u + self.deadband)
+		else:
+			w_ss = 0.0
+		return (w_ss - self.speed) * self.inv_tau
+
+	# position in counts, time in ns (monotonic_ns()).
+	def update(self,position,time):
+		if (not self.started):
+			self.started = True
+			self.position = position
+			self.last_time = time
+			return
+		h = (time - self.last_time) / 10**9
+		self.last_time = time
+		speed = self.speed
+		x = self.position + speed * h
+		speed += (self._model() + self.disturbance) * h
+		r = position - x
+		self.position = x + self.g * r
+		self.speed = speed + self.h * r
+		self.disturbance += self.k * r
+
+	# Integer counts per second, for Fixed_PID.update().
+	def counts_per_second(self):
+		return int(self.speed)
+
+	# counts per ns
+	def velocity(self):
+		return self.speed / 10**9
+
+
+# Speed from the time between encoder edges at low speed, from count differences at high speed.
+#
+# At low target speeds a 2 ms tick sees 0 or 1 counts, so dx/dt is mostly 0 with the odd spike.
+# There the time between edges on one encoder channel is the better measurement:
+# 	speed = counts_per_edge / edge_period
+# 4x decoding gives 2 counts per edge of one channel.
+# Edge periods come from a pulseio.PulseIn style source (len(), popleft(), us durations).
+# PulseIn can't tell direction, so the sign is taken from the count difference.
+#
+# Mode switches with hysteresis on counts per tick:
+# 	|dx| >= count_above		count mode	(dx/dt, same as get_dx() / get_dt())
+# 	|dx| <= period_below	period mode
+# In period mode with no new edges, speed is capped at counts_per_edge / (time since last edge),
+# so it decays to 0 when the motor stops instead of holding the last period.
+class Edge_Velocity():
+	def __init__(self,pulses,**kwargs):
+		# Setup default values.
+		buffer = {
+			'counts_per_edge' : 2,
+			'count_above' : 8,		# counts per tick
+			'period_below' : 4		# counts per tick
+		}
+		for arg in buffer:
+			buffer[arg] = kwargs.get(arg,buffer[arg])
+		self.pulses = pulses
+		self.counts_per_edge = buffer['counts_per_edge']
+		self.count_above = buffer['count_above']
+		self.period_below = buffer['period_below']
+		self.reset()
+
+	def reset(self):
+		self.started = False
+		self.last_position = 0
+		self.last_time = 0
+		self.last_edge = 0
+		self.direction = 1
+		self.period_mode = True
+		self.speed = 0.0		# counts/s
+		self.pulses.clear()
+
+	# position in counts, time in ns (monotonic_ns()).
+	def update(self,position,time):
+		pulses = self.pulses
+		if (not self.started):
+			self.started = True
+			self.last_position = position
+			self.last_time = time
+			self.last_edge = time
+			pulses.clear()
+			return
+
+		dx = position - self.last_position
+		dt = time - self.last_time
+		self.last_position = position
+		self.last_time = time
+		if (dx > 0):
+			self.direction = 1
+		elif (dx < 0):
+			self.direction = -1
+
+		# Drain the edges seen this tick.
+		edges = 0
+		total_us = 0
+		while len(pulses):
+			total_us += pulses.popleft()
+			edges += 1
+		if edges:
+			self.last_edge = time
+
+		magnitude = abs(dx)
+		if (magnitude >= self.count_above):
+			self.period_mode = False
+		elif (magnitude <= self.period_below):
+			self.period_mode = True
+
+		if (not self.period_mode) and dt:
+			self.speed = dx * 10**9 / dt
+		elif (edges and total_us):
+			self.speed = self.direction * self.counts_per_edge * edges * 10**6 / total_us
+		else:
+			since_edge = time - self.last_edge
+			if since_edge:
+				cap = self.counts_per_edge * 10**9 / since_edge
+				if (abs(self.speed) > cap):
+					self.speed = self.direction * cap
+
+	# Integer counts per second, for Fixed_PID.update().
+	def counts_per_second(self):
+		return int(self.speed)
+
+	# counts per ns
+	def velocity(self):
+		return self.speed / 10**9
@@ -0,0 +1,88 @@
+# US Naval Academy
+# Robotics and Control TSD
+#
+# Feedforward map: target speed -> wiper code, from a sweep of all 1024 AD5293 codes.
+#
+# Quanser_305.characterize() runs the sawtooth over every code and hands the steady state
+# speed at each one (counts/s) to Feedforward_Map(). That gets inverted once into a lookup table:
+# 	lut[k + buckets]	code offset from 511 that reaches k * step counts/s, k in [-buckets, buckets]
+# so ff() is one multiply and one array index.
+#
+# ff() is in set_pot() units, same as bias, and replaces it: the deadband is already in the map.
+#
+# ex:
+# 	ff_map = Feedforward_Map(speeds)
+# 	bias = ff_map.ff(target_speed)		target_speed in counts/ns
+#
+
+from array import array
+
+class Feedforward_Map():
+	# speeds: steady state counts/s at each code 0..1023, or None for a saved table (see from_dict()).
+	def __init__(self,speeds=None,buckets=256):
+		self.buckets = buckets
+		self.lut = array('h',(0 for _ in range(2*buckets + 1)))
+		self.step = 1
+		self.inv_step = 1
+		if speeds:
+			self.build(speeds)
+
+	# Smallest code offset (from 511) whose speed reaches each bucket, both directions.
+	def build(self,speeds):
+		# Speed has to be monotonic in the code to invert it. Noise and the deadband aren't,
+		# so take the running max going up from 511 and the running min going down.
+		up = []
+		peak = 0
+		for code in range(511,1024):
+			peak = max(peak,speeds[code])
+			up.append(peak)
+		down = []
+		peak = 0
+		for code in range(511,-1,-1):
+			peak = min(peak,speeds[code])
+			down.append(-peak)
+
+		# Symmetric range, limited by the slower direction so every bucket is reachable.
+		top = min(up[-1],down[-1])
+		if (top <= 0):
+			return
+		n = self.buckets
+		self.step = top / n
+		self.inv_step = n / top
+		lut = self.lut
+		for table, sign in ((up, 1), (down, -1)):
+			offset = 0
+			for k in range(1,n + 1):
+				target = k * self.step
+				while (offset < len(table) - 1) and (table[offset] < target):
+					offset += 1
+				lut[n + sign*k] = sign * offset
+		lut[n] = 0
+
+	# target_speed in counts/ns -> set_pot() units.
+	def ff(self,target_speed):
+		n = self.buckets
+		k = int(target_speed * 10**9 * self.inv_step + (0.5 if (target_speed >= 0) else -0.5))
+		if (k > n):
+			k = n
+		elif (k < -n):
+			k = -n
+		return self.lut[k + n] / 512
+
+	# Highest speed in the table, counts/s.
+	def max_speed(self):
+		return self.step * self.buckets
+
+	# For the calibration cache.
+	def to_dict(self):
+		return {'step' : self.step, 'lut' : list(self.lut)}
+
+	@classmethod
+	def from_dict(cls,data):
+		lut = data['lut']
+		ff_map = cls(buckets=(len(lut) - 1) // 2)
+		for i in range(len(lut)):
+			ff_map.lut[i] = lut[i]
+		ff_map.step = data['step']
+		ff_map.inv_step = 1 / data['step']
+		return ff_map
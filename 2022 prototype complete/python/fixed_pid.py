@@ -0,0 +1,232 @@
+# US Naval Academy
+# Robotics and Control TSD
+#
+# Integer fixed point version of control_loop_P / PI / PID from code.py.
+#
+# The float controllers scale gains by 10**9 and 10**18 and divide by ns deltas.
+# On CircuitPython that means long int math every tick.
+# Here everything is an integer that fits a small int (< 2**30):
+# 	error		counts per second
+# 	dt			microseconds
+# 	terms		Q16 wiper codes (1 code = 1<<16)
+# 	output		wiper code [0,1023], handed straight to AD5293_309.set_raw()
+#
+# Each gain is stored as (pre_shift, mantissa, post_shift):
+# 	term = ((x >> pre_shift) * mantissa) >> post_shift
+# pre_shift keeps x under 2**16, mantissa stays under 2**14, so the product stays a small int.
+#
+# Wiper codes agree with the float laws to within one. Whether it's any faster, or easier on the heap,
+# only shows on the RP2040: run compare() there (on CPython the two cost about the same).
+#
+
+Q = 16
+ONE = 1 << Q
+HALF = 1 << (Q - 1)
+MANTISSA_BITS = 14
+X_BITS = 16
+
+# Clamp on the integral, in Q16 codes. Anything past this is saturated output anyway.
+I_LIMIT = 2048 << Q
+
+# Typical bounds on the input of each term, used to size the shifts.
+# Going past them is still correct, the product just stops being a small int.
+E_MAX = 1 << 15			# counts/s, ~100 rad/s at 2000 counts/rev
+EDT_MAX = 1 << 27		# counts/s * us, E_MAX over a 4 ms tick
+DE_MAX = 1 << 17		# (delta error << 8) // dt_us, with dt_us >= 256
+
+def bit_length(n):
+	n = abs(int(n))
+	bits = 0
+	while n:
+		n >>= 1
+		bits += 1
+	return bits
+
+# Float gain g (Q16 codes per unit of x) -> (pre_shift, mantissa, post_shift).
+def to_fixed(g,x_max):
+	pre = max(0, bit_length(x_max) - X_BITS)
+	scaled = abs(g) * (1 << pre)
+	if (not scaled):
+		return 0, 0, 0
+	post = 0
+	while (scaled * (1 << (post + 1)) < (1 << MANTISSA_BITS)):
+		post += 1
+	m = int(scaled * (1 << post) + 0.5)
+	if (g < 0):
+		m = -m
+	return pre, m, post
+
+
+class Fixed_PID():
+	# pid, target_speed and bias in the same units as code.py:
+	# 	pid['Kp'] (x10**9), pid['Ki'], pid['Kd'] (x10**18), target_speed in counts/ns, bias in [-1,1]
+	# law: 'P', 'PI' or 'PID', same terms as control_loop_P / PI / PID.
+	def __init__(self,pid=None,target_speed=0,bias=0,law='PID'):
+		self.configure(pid or {'Kp' : 0, 'Ki' : 0, 'Kd' : 0},target_speed,bias,law)
+
+	def configure(self,pid,target_speed,bias,law='PID'):
+		self.law = law
+		self.target = int(target_speed * 10**9 + 0.5)		# counts/s
+
+		# Float term -> Q16 codes. set_pot() maps [-1,1] onto 511.5 codes either side of 511.
+		# 	P:	Kp * e[counts/ns]						= (Kp / 1e9) * e[counts/s]
+		# 	I:	Ki * e[counts/ns] * dt[ns]				= (Ki / 1e6) * e[counts/s] * dt[us]
+		# 	D:	Kd * de[counts/ns] / dt[ns]				= (Kd / 1e12) * de[counts/s] / dt[us]
+		codes = 511.5 * ONE
+		self.bias = int(bias * codes + 0.5) if (bias >= 0) else -int(-bias * codes + 0.5)
+		self.kp = to_fixed(pid['Kp'] * codes / 10**9, E_MAX)
+		self.ki = to_fixed(pid['Ki'] * codes / 10**6, EDT_MAX) if ('I' in law) else (0, 0, 0)
+		self.kd = to_fixed(pid['Kd'] * codes / 10**12 / 256, DE_MAX) if ('D' in law) else (0, 0, 0)
+		self.reset()
+
+	def reset(self):
+		self.i_term = 0
+		self.last_error = 0
+		self.error = 0
+
+	# dx in counts, dt in ns (as from Quanser_305.get_dx() / get_dt()). Returns the wiper code.
+	# speed (counts/s) replaces dx/dt when it comes from an estimator, dt is still used for I and D.
+	def update(self,dx,dt,speed=None):
+		dt_us = dt // 1000
+		if (dt_us < 1):
+			dt_us = 1
+		if (speed is None):
+			speed = (dx * 1000000) // dt_us
+		error = self.target - speed
+
+		pre, m, post = self.kp
+		u = self.bias + (((error >> pre) * m) >> post)
+
+		pre, m, post = self.ki
+		if m:
+			# Round instead of floor on both shifts, or the integral drifts one way over a run.
+			edt = error * dt_us
+			if pre:
+				edt = (edt + (1 << (pre - 1))) >> pre
+			edt *= m
+			if post:
+				edt = (edt + (1 << (post - 1))) >> post
+			i_term = self.i_term + edt
+			if (i_term > I_LIMIT):
+				i_term = I_LIMIT
+			elif (i_term < -I_LIMIT):
+				i_term = -I_LIMIT
+			self.i_term = i_term
+			u += i_term
+
+		pre, m, post = self.kd
+		if m:
+			u += (((((error - self.last_error) << 8) // dt_us >> pre) * m) >> post)
+
+		self.last_error = error
+		self.error = error
+
+		# Same rounding as AD5293_309._transform(): int() of (value + 0.5), truncated toward 0.
+		u += HALF
+		if (u >= 0):
+			code = (u >> Q) + 511
+		else:
+			code = 511 - ((-u) >> Q)
+		if (code < 0):
+			return 0
+		if (code > 1023):
+			return 1023
+		return code
+
+
+
+
+###################################
+######### Testing Section #########
+###################################
+
+# Float law from code.py control_loop_PID, as a tick function like Fixed_PID.update().
+# Gains are locals like in controllers.build_PID(), so the timing is against the float registry controllers.
+def _float_law(pid,target_speed,bias,law):
+	kp = pid['Kp']
+	ki = pid['Ki']
+	kd = pid['Kd']
+	use_i = ('I' in law)
+	use_d = ('D' in law)
+	state = [0, 0]		# i_term, last_error
+	def update(dx,dt):
+		error = target_speed - (dx / dt)
+		u = bias + kp * error
+		if use_i:
+			state[0] += ki * error * dt
+			u += state[0]
+		if use_d:
+			u += kd * (error - state[1]) / dt
+		state[1] = error
+		return min(max(int((511.5 * u) + 0.5) + 511,0),1023)
+	return update
+
+# ns per tick, and bytes allocated per tick where gc.mem_free() exists (CircuitPython), else None.
+# The collector is off for the run, so the mem_free() drop is everything the ticks allocated.
+def _measure(update,dxs,dts):
+	import gc
+	from time import monotonic_ns
+	has_mem = hasattr(gc,'mem_free')
+	gc.collect()
+	gc.disable()
+	if has_mem:
+		free = gc.mem_free()
+	start = monotonic_ns()
+	for i in range(len(dxs)):
+		update(dxs[i],dts[i])
+	elapsed = monotonic_ns() - start
+	used = (free - gc.mem_free()) if has_mem else None
+	gc.enable()
+	return elapsed // len(dxs), (used / len(dxs)) if has_mem else None
+
+# Equivalence check of Fixed_PID against the float controllers, and what each costs per tick.
+# Feeds both the same noisy (dx, dt) sequence and reports the worst disagreement in wiper codes,
+# ns per tick and, on the RP2040, heap bytes per tick. Runs on the host or the device:
+# ex:	python3 fixed_pid.py
+# 		import fixed_pid; fixed_pid.compare()		from the REPL, ticks defaults to 500 there
+def compare(pid=None,target_speed=None,bias=20/511,ticks=None,tolerance=2,seed=305):
+	import gc
+	import random
+	from array import array
+	tau = 6.283185307179586
+	counts_per_rev = 2000
+	if (ticks is None):
+		ticks = 500 if hasattr(gc,'mem_free') else 5000
+	if (pid is None):
+		pid = {
+			'Kp' : 0.00003 * 10**9,
+			'Ki' : 0.0004,
+			'Kd' : 0.00000001 * 10**18
+		}
+	if (target_speed is None):
+		target_speed = (10 / tau) * counts_per_rev / 10**9
+
+	random.seed(seed)
+	dxs = array('l')
+	dts = array('l')
+	for _ in range(ticks):
+		dt = 2000000 + random.randint(-30000,30000)				# ~2 ms tick with jitter
+		dxs.append(int(target_speed * dt * random.uniform(0.0,1.6)))	# counts, quantized
+		dts.append(dt)
+
+	worst = 0
+	for law in ('P','PI','PID'):
+		reference = _float_law(pid,target_speed,bias,law)
+		controller = Fixed_PID(pid,target_speed,bias,law)
+		diff = 0
+		for i in range(ticks):
+			diff = max(diff,abs(reference(dxs[i],dts[i]) - controller.update(dxs[i],dts[i])))
+		worst = max(worst,diff)
+		controller.reset()
+		fixed_ns, fixed_bytes = _measure(controller.update,dxs,dts)
+		float_ns, float_bytes = _measure(_float_law(pid,target_speed,bias,law),dxs,dts)
+		line = 'LOG: ' + law + ': max diff ' + str(diff) + ' codes, fixed ' + str(fixed_ns) + ' ns/tick, float ' + str(float_ns) + ' ns/tick'
+		if (fixed_bytes is not None):
+			line += ', heap fixed %0.1f B/tick, float %0.1f B/tick' %(fixed_bytes, float_bytes)
+		print(line)
+	print('LOG: ' + ('PASS' if (worst <= tolerance) else 'FAIL') + ' tolerance ' + str(tolerance) + ' codes')
+	return worst <= tolerance
+
+
+if __name__ == '__main__':
+	compare()
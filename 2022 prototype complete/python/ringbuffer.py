@@ -0,0 +1,62 @@
+# US Naval Academy
+# Robotics and Control TSD
+#
+# Fixed capacity ring buffer for (position, time) encoder samples.
+# Replaces the list.pop(0) / list.append() pattern, which is a memmove of the
+# whole list every control tick. Here a tick is 2 stores and an index bump.
+#
+
+from array import array
+
+class Ring_Buffer():
+	def __init__(self,size):
+		self.size = size
+		# Encoder counts fit in 32 bits.
+		self.position = array('l',(0 for _ in range(size)))
+		# monotonic_ns() overflows 32 bits after ~2.1s, so timestamps get 64 bits.
+		self.time = array('q',(0 for _ in range(size)))
+
+		# Next slot to be written, and number of valid samples (saturates at size).
+		self.index = 0
+		self.count = 0
+		# Total samples appended since reset(). Doesn't saturate, used for streaming.
+		self.written = 0
+
+	# Old values are left in place; nothing reads past 'count'.
+	def reset(self):
+		self.index = 0
+		self.count = 0
+		self.written = 0
+
+	def append(self,position,time):
+		i = self.index
+		self.position[i] = position
+		self.time[i] = time
+		i += 1
+		if (i == self.size):
+			i = 0
+		self.index = i
+		self.written += 1
+		if (self.count < self.size):
+			self.count += 1
+
+	# Difference between the newest sample and the one at 'offset'.
+	# 	-1 is the newest, -2 the one before it, etc.
+	def dx(self,offset):
+		return self.position[self.index - 1] - self.position[(self.index + offset) % self.size]
+
+	def dt(self,offset):
+		return self.time[self.index - 1] - self.time[(self.index + offset) % self.size]
+
+	# Slot of the oldest valid sample.
+	def oldest(self):
+		if (self.count < self.size):
+			return 0
+		return self.index
+
+	# Yield (position, time) oldest first. Not for use in the hot loop.
+	def ordered(self):
+		start = self.oldest()
+		for n in range(self.count):
+			i = (start + n) % self.size
+			yield self.position[i], self.time[i]
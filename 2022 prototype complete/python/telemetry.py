@@ -0,0 +1,58 @@
+# US Naval Academy
+# Robotics and Control TSD
+#
+# Binary telemetry frames for sample export.
+# Replaces one dumps() + print() per sample with one line per run.
+#
+# Frame, little endian:
+# 	header		'<4sBBIfq'		magic b'Q305', version, flags, count, counts_per_rev, t0 (ns)
+# 	positions	count * int32	raw encoder counts
+# 	deltas		count * int32	ns since the previous sample, first one is 0
+# 	checksum	uint32			crc32 of everything before it (additive sum32 if flags says so)
+#
+# The USB console is a text stream (newlines get cooked), so the frame goes out
+# base64 encoded on a single line starting with 'BIN:'.
+# Decoded on the host by host/decode_telemetry.py.
+#
+
+from struct import pack_into, calcsize
+from binascii import b2a_base64
+try:
+	from binascii import crc32
+except ImportError:
+	crc32 = None
+
+MAGIC = b'Q305'
+VERSION = 1
+FLAG_CRC32 = 0x01
+HEADER = '<4sBBIfq'
+HEADER_SIZE = calcsize(HEADER)
+
+def checksum(data):
+	if crc32:
+		return crc32(data) & 0xffffffff
+	return sum(data) & 0xffffffff
+
+# Pack 'count' samples of a Ring_Buffer, starting at slot 'start', into one frame.
+def encode_frame(samples,counts_per_rev,start,count):
+	frame = bytearray(HEADER_SIZE + 8*count + 4)
+	size = samples.size
+	t0 = samples.time[start % size]
+	flags = FLAG_CRC32 if crc32 else 0
+	pack_into(HEADER,frame,0,MAGIC,VERSION,flags,count,counts_per_rev,t0)
+
+	pos_offset = HEADER_SIZE
+	dt_offset = HEADER_SIZE + 4*count
+	last_time = t0
+	for n in range(count):
+		i = (start + n) % size
+		pack_into('<i',frame,pos_offset + 4*n,samples.position[i])
+		pack_into('<i',frame,dt_offset + 4*n,samples.time[i] - last_time)
+		last_time = samples.time[i]
+
+	end = HEADER_SIZE + 8*count
+	pack_into('<I',frame,end,checksum(memoryview(frame)[:end]))
+	return frame
+
+def frame_to_line(frame):
+	return 'BIN:' + b2a_base64(frame).decode().strip()
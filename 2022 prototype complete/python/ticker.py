@@ -5,15 +5,49 @@
 #
 
 from time import monotonic_ns
+from array import array
 
 class Interrupt_Controller():
-	def __init__(self):
+	# obj = Interrupt_Controller(scheduler='scan' or 'deadline')
+	#	'scan'		check every ticker on every spin of loop(). The original.
+	#	'deadline'	keep the next deadline of each ticker in a min-heap.
+	#				Each spin is one comparison against the earliest deadline.
+	#
+	# obj = Interrupt_Controller(timing='relative' or 'fixed', catch_up='skip' or 'burst')
+	#	'relative'	the delay counts from the end of the last callback. The original.
+	#				Real period is delay + callback time + scan time.
+	#	'fixed'		each deadline advances by exactly one period, so 500 Hz is 500 Hz.
+	#				Always uses the deadline scheduler.
+	#	catch_up	what 'fixed' does after a callback overran one or more deadlines.
+	#		'skip'	drop the missed ticks, next run is the next deadline still in the future.
+	#		'burst'	run the missed ticks back to back until caught up.
+	#
+	# obj = Interrupt_Controller(stats=True)
+	#	Per ticker call count, callback duration, lateness and missed deadlines.
+	#	Kept in integer arrays allocated when loop() starts. Read with get_stats() after loop().
+	#	Always uses the deadline scheduler.
+	#
+	# obj = Interrupt_Controller(clock=func, idle=func)
+	#	clock		ns time source, monotonic_ns by default.
+	#	idle		called with the next deadline (ns) when nothing is due, instead of spinning.
+	#				A virtual clock jumps straight to it (see sim/vclock.py).
+	#				Always uses the deadline scheduler.
+	def __init__(self,**kwargs):
 		self._armed = False
 		self.min_delay = 0 # Don't allow negative numbers for the delay.
 
 		# Where our tickers will get stored.
 		self.tickers = {}
 
+		self.scheduler = kwargs.get('scheduler','scan')
+		self.timing = kwargs.get('timing','relative')
+		self.catch_up = kwargs.get('catch_up','skip')
+		self.stats = kwargs.get('stats',False)
+		self.clock = kwargs.get('clock',monotonic_ns)
+		self.idle = kwargs.get('idle',None)
+		self._reset_stats(0)
+		self._schedule_size = -1
+
 	# I use this function in all my classes.
 	def clamp_val(self, n):
 		return (max(n, self.min_delay))
@@ -46,7 +80,14 @@ class Interrupt_Controller():
 			print("LOG: Error. Loops running.")
 
 	def loop(self):
+		if ((self.scheduler == 'deadline') or (self.timing == 'fixed') or self.stats or self.idle):
+			self.loop_deadline()
+		else:
+			self.loop_scan()
+
+	def loop_scan(self):
 		self.arm()
+		monotonic_ns = self.clock
 		now = monotonic_ns()	# ns
 		last_ran = {}			# dictionary to store when each ticker's callback was last executed.
 		conversion = 10**9		# seconds <> nanoseconds
@@ -70,6 +111,172 @@ class Interrupt_Controller():
 			# Update the time.
 			now = monotonic_ns()
 
+	# Snapshot the tickers into flat arrays, indexed in the order they were added.
+	# Periods are converted to integer ns once, here, instead of on every check.
+	# The arrays are kept and refilled in place while the number of tickers doesn't change,
+	# so back to back runs don't allocate a new schedule each time.
+	def _build_schedule(self,now):
+		count = len(self.tickers)
+		if (self._schedule_size != count):
+			self._periods = array('q',(0 for _ in range(count)))
+			self._deadlines = array('q',(0 for _ in range(count)))
+			self._schedule_size = count
+		periods = self._periods
+		deadlines = self._deadlines
+		functions = []
+		for i,v in enumerate(self.tickers.values()):
+			periods[i] = int(self.clamp_val(v[0]) * 10**9)
+			deadlines[i] = now		# Everything runs at start.
+			functions.append(v[1])
+		# All deadlines are equal, so index order is already a valid heap.
+		heap = list(range(count))
+		return periods, deadlines, functions, heap
+
+	# Restore the heap after the deadline of heap[0] moved later.
+	# Ties go to the lower index, so tickers due together run in the order they were added.
+	def _sift_down(self,heap,deadlines):
+		count = len(heap)
+		pos = 0
+		k = heap[0]
+		while True:
+			child = 2*pos + 1
+			if (child >= count):
+				break
+			right = child + 1
+			if (right < count):
+				a = heap[child]
+				b = heap[right]
+				if ((deadlines[b] < deadlines[a]) or ((deadlines[b] == deadlines[a]) and (b < a))):
+					child = right
+			c = heap[child]
+			if ((deadlines[c] < deadlines[k]) or ((deadlines[c] == deadlines[k]) and (c < k))):
+				heap[pos] = c
+				pos = child
+			else:
+				break
+		heap[pos] = k
+
+	# One slot per ticker, all ns. Lateness is how long after its deadline a callback started.
+	def _reset_stats(self,count):
+		self._stat_names = list(self.tickers)[:count]
+		self._stat_calls = array('q',(0 for _ in range(count)))
+		self._stat_dur_min = array('q',(2**62 for _ in range(count)))
+		self._stat_dur_max = array('q',(0 for _ in range(count)))
+		self._stat_dur_sum = array('q',(0 for _ in range(count)))
+		self._stat_late_min = array('q',(2**62 for _ in range(count)))
+		self._stat_late_max = array('q',(0 for _ in range(count)))
+		self._stat_late_sum = array('q',(0 for _ in range(count)))
+		self._stat_missed = array('q',(0 for _ in range(count)))
+		self._stat_counted = array('q',(0 for _ in range(count)))	# Last deadline already counted in missed.
+
+	# obj.get_stats() -> {name : {...}}, times in seconds.
+	# 	jitter is the spread of lateness (max - min), which bounds the period jitter.
+	def get_stats(self):
+		results = {}
+		for i,name in enumerate(self._stat_names):
+			calls = self._stat_calls[i]
+			if (not calls):
+				results[name] = {'calls' : 0, 'missed' : self._stat_missed[i]}
+				continue
+			results[name] = {
+				'calls' : calls,
+				'duration_min' : self._stat_dur_min[i] / 10**9,
+				'duration_mean' : self._stat_dur_sum[i] / calls / 10**9,
+				'duration_max' : self._stat_dur_max[i] / 10**9,
+				'late_mean' : self._stat_late_sum[i] / calls / 10**9,
+				'late_max' : self._stat_late_max[i] / 10**9,
+				'jitter' : (self._stat_late_max[i] - self._stat_late_min[i]) / 10**9,
+				'missed' : self._stat_missed[i]
+			}
+		return results
+
+	def print_stats(self):
+		for name,v in self.get_stats().items():
+			print('LOG: ' + str(name) + ': ' + str(v))
+
+	def loop_deadline(self):
+		self.arm()
+		if (not self.tickers):
+			return
+		monotonic_ns = self.clock
+		idle = self.idle
+		periods, deadlines, functions, heap = self._build_schedule(monotonic_ns())
+		fixed = (self.timing == 'fixed')
+		skip = (self.catch_up == 'skip')
+		stats = self.stats
+		if stats:
+			self._reset_stats(len(functions))
+			calls = self._stat_calls
+			dur_min = self._stat_dur_min
+			dur_max = self._stat_dur_max
+			dur_sum = self._stat_dur_sum
+			late_min = self._stat_late_min
+			late_max = self._stat_late_max
+			late_sum = self._stat_late_sum
+			missed = self._stat_missed
+			counted = self._stat_counted
+		k = heap[0]
+		next_due = deadlines[k]
+
+		while(self._armed):
+			if (monotonic_ns() >= next_due):
+
+				if stats:
+					start = monotonic_ns()
+
+				# Callback.
+				functions[k]()
+
+				if stats:
+					now = monotonic_ns()
+					duration = now - start
+					late = start - next_due
+					calls[k] += 1
+					dur_sum[k] += duration
+					late_sum[k] += late
+					if (duration < dur_min[k]):
+						dur_min[k] = duration
+					if (duration > dur_max[k]):
+						dur_max[k] = duration
+					if (late < late_min[k]):
+						late_min[k] = late
+					if (late > late_max[k]):
+						late_max[k] = late
+					# Started after the following deadline had passed too.
+					# 'skip' counts the deadlines it drops below instead.
+					# 'burst' catch-up calls are all late for the same overrun,
+					# only deadlines past the last one counted are new.
+					if (periods[k] and not (fixed and skip)):
+						since = next_due
+						if (counted[k] > since):
+							since = counted[k]
+						passed = (start - since) // periods[k]
+						if (passed > 0):
+							missed[k] += passed
+							counted[k] = since + passed * periods[k]
+
+				if fixed:
+					# Advance by exactly one period from the deadline, not from now.
+					next_due += periods[k]
+					if skip:
+						now = monotonic_ns()
+						if ((next_due <= now) and periods[k]):
+							dropped = (now - next_due) // periods[k] + 1
+							next_due += dropped * periods[k]
+							if stats:
+								missed[k] += dropped
+					deadlines[k] = next_due
+				else:
+					# Same timing as loop_scan(): the delay counts from the end of the callback.
+					deadlines[k] = monotonic_ns() + periods[k]
+
+				self._sift_down(heap,deadlines)
+				k = heap[0]
+				next_due = deadlines[k]
+
+			elif idle:
+				idle(next_due)
+
 	def pause(self):
 		self._armed = False
 
@@ -83,7 +290,8 @@ class Interrupt_Controller():
 
 	def remove_interrupt_all(self):
 		self.pause()
-		for key in self.tickers:
+		# Copy the keys, the dict shrinks as we go.
+		for key in list(self.tickers):
 			self.remove_interrupt(key)
 
 
@@ -93,6 +301,49 @@ class Interrupt_Controller():
 
 
 
+#####################################
+#####################################
+########## Testing Section ##########
+#####################################
+#####################################
+
+# One 10 ms overrun in 100 ticks at 500 Hz, on a fake clock so it's exact.
+# Deadlines 4, 6, 8 and 10 ms after the late tick's own had passed when it started: 4 missed, once.
+# 	burst	all 100 ticks run, 4 missed
+# 	skip	the 5 deadlines up to the end of the overrun are dropped, 95 run
+# 	relative	the next delay counts from the end of the overrun, 95 run, nothing missed
+# ex:	python3 -c "import ticker; ticker.check()"
+def check():
+	class Clock():
+		now = 0
+		def monotonic_ns(self):
+			return self.now
+		def wait_until(self,ns):
+			if (ns > self.now):
+				self.now = ns
+	expected = {('fixed','burst') : (100, 4), ('fixed','skip') : (95, 5), ('relative','skip') : (95, 0)}
+	ok = True
+	for (timing, catch_up), (runs, misses) in expected.items():
+		clock = Clock()
+		controller = Interrupt_Controller(timing=timing,catch_up=catch_up,stats=True,clock=clock.monotonic_ns,idle=clock.wait_until)
+		ticks = [0]
+		def tick():
+			ticks[0] += 1
+			if (ticks[0] == 10):
+				clock.now += 10 * 10**6
+			if (clock.now >= (99 * 2 * 10**6)):
+				controller.pause()
+		controller.interrupt(name='tick',delay=0.002,function=tick)
+		controller.loop()
+		stats = controller.get_stats()['tick']
+		passed = (stats['calls'] == runs) and (stats['missed'] == misses)
+		ok = ok and passed
+		print('LOG: ' + timing + ' ' + catch_up + ': ' + str(stats['calls']) + ' calls, ' + str(stats['missed']) + ' missed, ' + ('PASS' if passed else 'FAIL'))
+	return ok
+
+
+
+
 #####################################
 #####################################
 ########## Example Section ##########
@@ -4,12 +4,19 @@ from time import monotonic_ns
 ######### Testing Section #########
 ###################################
 
+# ns time source for tictoc, swap in a virtual clock's with set_clock().
+clock = monotonic_ns
+
+def set_clock(func):
+	global clock
+	clock = func
+
 # Wrapper for timing function execution.
 def tictoc(func):
 	def wrapper(*args):
-		start = monotonic_ns()
+		start = clock()
 		func(*args)
-		end = monotonic_ns()
+		end = clock()
 		# print(func)
 		print(str(func)+': '+str((end-start) / (10**9)))
 	return wrapper
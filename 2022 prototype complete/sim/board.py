@@ -0,0 +1,18 @@
+# US Naval Academy
+# Robotics and Control TSD
+#
+# Host-side stand-in for CircuitPython's board module (Raspberry Pi Pico pinout).
+#
+
+class Pin():
+	def __init__(self,name):
+		self.name = name
+
+	def __repr__(self):
+		return 'board.' + self.name
+
+for _n in range(29):
+	globals()['GP' + str(_n)] = Pin('GP' + str(_n))
+
+LED = GP25
+board_id = 'raspberry_pi_pico'
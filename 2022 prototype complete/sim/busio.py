@@ -0,0 +1,42 @@
+# US Naval Academy
+# Robotics and Control TSD
+#
+# Host-side stand-in for CircuitPython's busio module.
+# SPI writes are decoded as AD5293 frames and the wiper code is handed to the motor model.
+#
+
+import motor
+
+class SPI():
+	def __init__(self,clock,MOSI=None,MISO=None):
+		self.clock = clock
+		self.MOSI = MOSI
+		self.MISO = MISO
+		self._locked = False
+		self.frames = 0
+
+	def try_lock(self):
+		if self._locked:
+			return False
+		self._locked = True
+		return True
+
+	def unlock(self):
+		self._locked = False
+
+	def configure(self,baudrate=100000,polarity=0,phase=0,bits=8):
+		self.baudrate = baudrate
+		self.polarity = polarity
+		self.phase = phase
+
+	# AD5293 datasheet page 19: 4 bit command, 10 bit data.
+	def write(self,buf,start=0,end=None):
+		if end is None:
+			end = len(buf)
+		for i in range(start,end-1,2):
+			self.frames += 1
+			if ((buf[i] >> 2) & 0x0f) == 0x01:
+				motor.plant.command(((buf[i] & 0x03) << 8) | buf[i+1])
+
+	def deinit(self):
+		self._locked = False
@@ -0,0 +1,23 @@
+# US Naval Academy
+# Robotics and Control TSD
+#
+# Host-side stand-in for CircuitPython's digitalio module.
+#
+
+class Direction():
+	INPUT = 'INPUT'
+	OUTPUT = 'OUTPUT'
+
+class Pull():
+	UP = 'UP'
+	DOWN = 'DOWN'
+
+class DigitalInOut():
+	def __init__(self,pin):
+		self.pin = pin
+		self.direction = Direction.INPUT
+		self.pull = None
+		self.value = 0
+
+	def deinit(self):
+		self.pin = None
@@ -0,0 +1,18 @@
+# US Naval Academy
+# Robotics and Control TSD
+#
+# Host-side stand-in for CircuitPython's microcontroller module.
+#
+
+import sys
+
+class _Processor():
+	uid = bytearray(b'\x00\x00\x00\x00\x00\x00\x03\x05')
+	frequency = 125000000
+	temperature = 25.0
+
+cpu = _Processor()
+
+# No soft reset on a host. End the process the way a reset ends code.py.
+def reset():
+	sys.exit(0)
@@ -0,0 +1,85 @@
+# US Naval Academy
+# Robotics and Control TSD
+#
+# DC motor plant model behind the host-side stand-ins for board, busio, rotaryio, etc.
+# The fake SPI bus feeds AD5293 wiper codes in, the fake IncrementalEncoder reads counts out.
+#
+# First order speed model with a symmetric deadband (static friction):
+# 	u     = (code - 511.5) / 511.5					[-1,1]
+# 	w_ss  = gain * (u - sign(u)*deadband)			0 inside the deadband
+# 	tau * dw/dt = w_ss - w
+#
+# The input is piecewise constant between SPI writes, so the plant is integrated exactly
+# (no step size) up to "now" whenever the wiper changes or the encoder is read.
+#
+
+from math import exp, pi
+from time import monotonic_ns
+
+class DC_Motor():
+	def __init__(self,**kwargs):
+		# Setup default values.
+		# Roughly matches the bench: ~28/512 codes of deadband, ~10 rad/s at bias + a few codes.
+		buffer = {
+			'gain' : 60.0,				# rad/s at full scale
+			'tau' : 0.05,				# seconds
+			'deadband' : 28 / 512,		# fraction of full scale
+			'deadband_negative' : None,	# reverse deadband if not the same, fraction of full scale
+			'counts_per_rev' : 2000,	# 4x decoded encoder counts
+			'clock' : monotonic_ns		# ns time source
+		}
+		for arg in buffer:
+			buffer[arg] = kwargs.get(arg,buffer[arg])
+		self.gain = buffer['gain']
+		self.tau = buffer['tau']
+		self.deadband = buffer['deadband']
+		self.deadband_negative = buffer['deadband_negative']
+		if (self.deadband_negative is None):
+			self.deadband_negative = self.deadband
+		self.counts_per_rev = buffer['counts_per_rev']
+		self.clock = buffer['clock']
+		# Edge sources (sim/pulseio.py) told about every step of update().
+		self.watchers = []
+		self.reset()
+
+	def reset(self):
+		self.code = 511
+		self.theta = 0.0	# rad
+		self.omega = 0.0	# rad/s
+		self.last_update = self.clock()
+
+	def steady_state(self,code):
+		u = (code - 511.5) / 511.5
+		if (u > self.deadband):
+			return self.gain * (u - self.deadband)
+		elif (u < -self.deadband_negative):
+			return self.gain * (u + self.deadband_negative)
+		return 0.0
+
+	# Advance the plant to the current time under the present wiper code.
+	def update(self):
+		now = self.clock()
+		then = self.last_update
+		h = (now - then) / 10**9
+		self.last_update = now
+		if (h <= 0):
+			return
+		w_ss = self.steady_state(self.code)
+		decay = exp(-h / self.tau)
+		theta = self.theta
+		self.theta += w_ss * h + (self.omega - w_ss) * self.tau * (1 - decay)
+		self.omega = w_ss + (self.omega - w_ss) * decay
+		for watcher in self.watchers:
+			watcher.advance(then,theta,now,self.theta)
+
+	def command(self,code):
+		self.update()
+		self.code = code
+
+	def counts(self):
+		self.update()
+		return int(self.theta * self.counts_per_rev / (2 * pi))
+
+
+# Shared by the stand-in modules so they all drive / read the same motor.
+plant = DC_Motor()
@@ -0,0 +1,74 @@
+# US Naval Academy
+# Robotics and Control TSD
+#
+# Host-side stand-in for CircuitPython's pulseio module.
+# PulseIn reports the us between edges of one encoder channel, made from the motor model.
+# One channel has counts_per_rev / 2 edges per rev with 4x decoding.
+# Edge times are interpolated linearly inside each step of the motor model.
+#
+
+from math import pi, floor
+import motor
+
+class PulseIn():
+	def __init__(self,pin,maxlen=2,idle_state=False,plant=None):
+		self.pin = pin
+		self.maxlen = maxlen
+		self.idle_state = idle_state
+		self.plant = plant or motor.plant
+		self.spacing = 2 * pi / (self.plant.counts_per_rev / 2)	# rad between edges
+		self._pulses = []
+		self._paused = False
+		self._last_edge = None
+		self.plant.watchers.append(self)
+
+	def advance(self,t_a,theta_a,t_b,theta_b):
+		if (self._paused) or (theta_a == theta_b):
+			return
+		k_a = floor(theta_a / self.spacing)
+		k_b = floor(theta_b / self.spacing)
+		if (k_a == k_b):
+			return
+		step = 1 if (k_b > k_a) else -1
+		# Edges sit at k*spacing. Going up, the first one crossed is k_a+1; going down, k_a.
+		k = k_a + 1 if (step > 0) else k_a
+		last = k_b if (step > 0) else k_b + 1
+		while True:
+			t = t_a + (k * self.spacing - theta_a) / (theta_b - theta_a) * (t_b - t_a)
+			if (self._last_edge is not None):
+				self._append(min(int((t - self._last_edge) / 1000),65535))
+			self._last_edge = t
+			if (k == last):
+				break
+			k += step
+
+	def _append(self,duration):
+		if (len(self._pulses) >= self.maxlen):
+			return
+		self._pulses.append(duration)
+
+	def __len__(self):
+		self.plant.update()
+		return len(self._pulses)
+
+	def __getitem__(self,i):
+		return self._pulses[i]
+
+	def popleft(self):
+		if (not self._pulses):
+			raise IndexError('pop from empty PulseIn')
+		return self._pulses.pop(0)
+
+	def clear(self):
+		self._pulses = []
+
+	def pause(self):
+		self._paused = True
+
+	def resume(self,trigger_duration=0):
+		self._paused = False
+		self._last_edge = None
+
+	def deinit(self):
+		if self in self.plant.watchers:
+			self.plant.watchers.remove(self)
@@ -0,0 +1,26 @@
+# US Naval Academy
+# Robotics and Control TSD
+#
+# Host-side stand-in for CircuitPython's rotaryio module.
+# Position comes from the motor model, already 4x decoded.
+#
+
+import motor
+
+class IncrementalEncoder():
+	def __init__(self,pin_a,pin_b,divisor=4):
+		self.pin_a = pin_a
+		self.pin_b = pin_b
+		self.divisor = divisor
+		self._offset = motor.plant.counts()
+
+	@property
+	def position(self):
+		return motor.plant.counts() - self._offset
+
+	@position.setter
+	def position(self,value):
+		self._offset = motor.plant.counts() - value
+
+	def deinit(self):
+		pass
@@ -0,0 +1,67 @@
+# US Naval Academy
+# Robotics and Control TSD
+#
+# Host-side stand-in for CircuitPython's supervisor module.
+#
+# sys.stdin is swapped for an unbuffered line reader on fd 0, so serial_bytes_available
+# (select on the fd) can't miss lines that a buffered TextIOWrapper already pulled in.
+# End of file on stdin is treated like the host closing the port: code.py exits.
+#
+
+import os
+import sys
+from select import select
+
+class _Serial_In():
+	def __init__(self,fd=0):
+		self.fd = fd
+		self.pending = b''
+
+	def fileno(self):
+		return self.fd
+
+	def _fill(self):
+		chunk = os.read(self.fd,4096)
+		if not chunk:
+			sys.exit(0)
+		self.pending += chunk
+
+	def available(self):
+		if self.pending:
+			return len(self.pending)
+		try:
+			if select([self.fd],[],[],0)[0]:
+				self._fill()
+		except (ValueError, OSError):
+			return 0
+		return len(self.pending)
+
+	def readline(self):
+		while b'\n' not in self.pending:
+			self._fill()
+		line, _, self.pending = self.pending.partition(b'\n')
+		return (line + b'\n').decode()
+
+	def read(self,n=1):
+		while len(self.pending) < n:
+			self._fill()
+		data = self.pending[:n]
+		self.pending = self.pending[n:]
+		return data.decode()
+
+
+class _Runtime():
+	@property
+	def serial_bytes_available(self):
+		return sys.stdin.available()
+
+	@property
+	def serial_connected(self):
+		return True
+
+
+sys.stdin = _Serial_In()
+runtime = _Runtime()
+
+def reload():
+	sys.exit(0)
@@ -0,0 +1,5 @@
+# US Naval Academy
+# Robotics and Control TSD
+#
+# Host-side stand-in for CircuitPython's ulab. ulab.numpy is a subset of numpy.
+#
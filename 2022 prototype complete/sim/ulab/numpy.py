@@ -0,0 +1,11 @@
+# US Naval Academy
+# Robotics and Control TSD
+#
+# Host-side stand-in for ulab.numpy.
+#
+
+try:
+	from numpy import *
+except ImportError:
+	# Enough for tictoc.py's example section without numpy installed.
+	from math import floor, ceil, pi, e, sqrt, exp
@@ -0,0 +1,41 @@
+# US Naval Academy
+# Robotics and Control TSD
+#
+# Discrete event virtual clock for the sim.
+#
+# Time only moves when something waits: sleep() adds to it, and the ticker's idle hook
+# (wait_until) jumps it to the next deadline instead of spinning. Apart from that, each read
+# costs read_ns, like a monotonic_ns() call does on the RP2040. Without it, back to back
+# samples (ie __prefill_arrays()) would share a timestamp and dt would be 0.
+# A 1s run at 500 Hz is ~500 callbacks of host time, and the sample timestamps are
+# the same on every run.
+#
+# 	SIM_VIRTUAL_CLOCK=1 PYTHONPATH=../sim python3 code.py
+# makes 'active' a Virtual_Clock, and code.py hands it to Quanser_305, tictoc and the motor model.
+# Unset, 'active' is None and everything runs on real time as before.
+#
+
+import os
+import motor
+
+class Virtual_Clock():
+	def __init__(self,start_ns=0,read_ns=1000):
+		self.now = start_ns
+		self.read_ns = read_ns
+
+	def monotonic_ns(self):
+		self.now += self.read_ns
+		return self.now
+
+	def sleep(self,seconds):
+		self.now += int(seconds * 10**9)
+
+	def wait_until(self,ns):
+		if (ns > self.now):
+			self.now = ns
+
+active = None
+if os.environ.get('SIM_VIRTUAL_CLOCK'):
+	active = Virtual_Clock()
+	motor.plant.clock = active.monotonic_ns
+	motor.plant.reset()
@@ -137,15 +137,16 @@ classdef ew305 < matlab.mixin.SetGet
                 obj.rate = varargin{7};     % sample rate; experimental. Results may vary.
             end
 
-            % Reset the RP2040 after each experiment.
-            %   MemAlloc issues may arise if not restarted.
-            obj.reset_rp2040();
+            % The RP2040 re-arms itself between experiments (Quanser_305.rearm()),
+            %   reset_rp2040() is only needed to recover from a crash.
+            obj.serial_device.flush();
 
             % Form the json string and fire it off into the ether.
 			commands = struct('target',obj.target,'Kp',obj.Kp,'Ki',obj.Ki,'Kd',obj.Kd,'time_limit',obj.runtime,'bias',obj.bias, 'rate',obj.rate);
 			obj.serial_device.writeline(jsonencode(commands));
 
-            % Due to post processing, hang out until the experiment is designed to finish.
+            % Hang out until the experiment is designed to finish.
+            %   read_serial() then reads up to the 'LOG: end' line.
             pause(obj.runtime + 1);
 			obj.read_serial();
             obj.graph_v()
@@ -176,7 +177,19 @@ classdef ew305 < matlab.mixin.SetGet
                 % continue churning and gathering the data into a struct
                 % array.
    			i=0; % Counter for data struct array.
-			while(obj.serial_device.NumBytesAvailable)
+            ended = false;  % Seen the 'LOG: end' line from Quanser_305.run_controller().
+            waiting = tic;
+			while((~ended) || obj.serial_device.NumBytesAvailable)
+                % Nothing yet, but the run isn't over.
+                %   The RP2040 stops the motor and prefills before 'LOG: end', give it time.
+                if (obj.serial_device.NumBytesAvailable==0)
+                    if (toc(waiting) > obj.runtime + 5)
+                        warning("No 'LOG: end' from the RP2040.");
+                        break;
+                    end
+                    pause(0.05);
+                    continue;
+                end
                 % Egyptians discovered zero some 3500 years ago, Olmecs 2500 years ago. Hindus, Chinese, and Arabs formalized zero in Mathematics during the 7th and 8th centuries.
                 %   And here, in 2022, MathWorks still believes the numbering system starts at one.
                 i = i+1;
@@ -186,6 +199,9 @@ classdef ew305 < matlab.mixin.SetGet
                 %   They cannot be parsed as json into a struct.
                 if (obj.check_serial_LOG())
                     disp(obj.buffer);
+                    % The end of run marker.
+                    ended = ended || startsWith(char(obj.buffer),'LOG: end');
+                    i = i-1;    % LOG lines aren't data, don't leave a hole in the data struct array.
 
                 % If not debugging messages, proceed with caution.
                 else
@@ -208,7 +224,7 @@ classdef ew305 < matlab.mixin.SetGet
                 % Make sure the serial buffer is truly zeroed out, and stays 0.
                 %   Sometimes after clearing the last line in serial buffer, 
                 %   another line is still coming from the microcontroller.
-                if (obj.serial_device.NumBytesAvailable==0)
+                if (ended && (obj.serial_device.NumBytesAvailable==0))
                     pause(0.1);
                 end
 